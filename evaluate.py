@@ -8,6 +8,8 @@ Inputs
     gt: (array: HxWx1 or HxW) Ground truth image which has two unique values only
     pred: (array: HxWx1 or HxW) Predicted image which has two unique values only
     HARD_LINE: (bool) If True, then all metrics are set to 0 when GT is a black image but prediction is not. 
+    fast: (bool) If True, tp, fp, tn, fn are counted with numpy boolean reductions. If False, 
+          the slower sklearn based reference implementation (evaluate_binary_sklearn) is used.
 
 Outputs
 ------------
@@ -26,9 +28,310 @@ It considers the following cases -
              It will consider the foreground as the y_true.     
 """
 import numpy as np
-from sklearn.metrics import confusion_matrix
+from concurrent.futures import ThreadPoolExecutor
 
-def evaluate_binary(gt, pred, HARD_LINE:bool=True):
+def confusion_binary(gt, pred):
+    """
+    It calculates tn, fp, fn, tp of two binary (or two-valued) arrays with boolean 
+    reductions, without copying or sorting. The larger of the two unique values is 
+    considered as the foreground, like sklearn's confusion_matrix does.
+    
+    Return
+    --------
+    tn, fp, fn, tp (np.int64)
+    """
+    flat_mask = np.ravel(gt) # view if contiguous, no copy
+    flat_pred = np.ravel(pred)
+    
+    # Foreground value. For binary images it is 1 (or True, or 255).
+    hi = max(flat_mask.max(), flat_pred.max()) if flat_mask.size else 0
+    
+    fg_mask = flat_mask == hi
+    fg_pred = flat_pred == hi
+    
+    n = flat_mask.size
+    tp = np.count_nonzero(np.logical_and(fg_mask, fg_pred))
+    n_mask = np.count_nonzero(fg_mask) # tp + fn
+    n_pred = np.count_nonzero(fg_pred) # tp + fp
+    
+    fp = n_pred - tp
+    fn = n_mask - tp
+    tn = n - tp - fp - fn
+    
+    return np.int64(tn), np.int64(fp), np.int64(fn), np.int64(tp)
+
+def evaluate_binary(gt, pred, HARD_LINE:bool=True, fast:bool=True):
+    
+    if not fast: return evaluate_binary_sklearn(gt, pred, HARD_LINE)
+    
+    # Remove single axis
+    flat_mask = np.ravel(np.squeeze(gt))
+    flat_pred = np.ravel(np.squeeze(pred))
+    
+    gt_empty = not flat_mask.any()
+    n_pred_nonzero = np.count_nonzero(flat_pred) if gt_empty else None
+    
+    return binary_metrics(confusion_binary(flat_mask, flat_pred), gt_empty, n_pred_nonzero, HARD_LINE)
+
+def binary_metrics(counts, gt_empty:bool, n_pred_nonzero, HARD_LINE:bool=True):
+    """
+    It calculates the evaluate_binary outputs from already counted values, so that the
+    counting can be done in any way (in memory, chunk by chunk, ...).
+    
+    Inputs
+    --------
+    counts: tn, fp, fn, tp, as returned by confusion_binary
+    gt_empty: (bool) True if GT has no foreground pixel
+    n_pred_nonzero: no. of non-zero pixels in the prediction. Only used if gt_empty is True.
+    HARD_LINE: (bool) Same as in evaluate_binary
+    
+    Return
+    --------
+    tp, fp, tn, fn, acc, sp, p, r, dice, iou
+    """
+    ep = 1e-6
+    
+    tn, fp, fn, tp = counts
+    n = tn + fp + fn + tp # no. of pixels
+    
+    'Case I: If there is no GT pixels in the image'
+    if gt_empty:
+        
+        'Case I.a: If both GT and prediction are black' 
+        if n_pred_nonzero == 0:
+            acc, sp, p, r, dice, iou = 100, 100, 100, 100, 100, 100
+            tn, fp, fn, tp = int(n), 0, 0, 0
+   
+        else:
+            'Case I.b: If GT is black, but prediction not'
+            if HARD_LINE:
+                acc, sp, p, r, dice, iou = 0, 0, 0, 0, 0, 0
+                tp, fn = 0, 0
+                fp = n_pred_nonzero # no. of non-zero pixels
+                tn = int(n) - fp # no. of zero intensity pixels
+                
+            else:
+                # Consider background pixels as y_true. With a black GT, the inverted GT
+                # is all foreground, so only itp (pred is 0) and ifn (pred is not 0) exist.
+                # tn, fp, fn, tp are kept as counted, without inversion.
+                itn, ifp = np.int64(0), np.int64(0)
+                ifn = np.int64(n_pred_nonzero)
+                itp = np.int64(n) - ifn
+                
+                acc = ((itp + itn)/(itp + itn + ifn + ifp))*100  
+                sp = (itn/(itn + ifp + ep))*100
+                p = (itp/(itp + ifp + ep))*100
+                r = (itp/(itp + ifn + ep))*100
+                dice = 0
+                iou = (itp/(itp + ifp + ifn + ep)) * 100
+    
+    else:
+        'Case II: If there is some GT pixels in the image'
+        acc = ((tp + tn)/(tp + tn + fn + fp))*100  
+        sp = (tn/(tn + fp + ep))*100
+        p = (tp/(tp + fp + ep))*100
+        r = (tp/(tp + fn + ep))*100
+        dice = (2 * tp / (2 * tp + fp + fn))*100
+        iou = (tp/(tp + fp + fn + ep)) * 100
+    
+    return tp, fp, tn, fn, acc, sp, p, r, dice, iou
+
+def binary_metrics_batch(tp, fp, tn, fn, gt_empty, pred_empty, itp, ifn, HARD_LINE:bool=True):
+    """
+    Array version of binary_metrics. It calculates the metrics of many samples (or classes)
+    at once from their counted values, and applies Case I.a / I.b / II with masks.
+    
+    Inputs
+    --------
+    tp, fp, tn, fn: arrays of counted values, one entry per sample
+    gt_empty, pred_empty: boolean arrays, True if GT / prediction has no foreground pixel
+    itp, ifn: counted values of the inverted GT for the Case I.b samples only (in the order of
+              those samples). Only used if HARD_LINE is False.
+    HARD_LINE: (bool) Same as in evaluate_binary
+    
+    Return
+    --------
+    per_sample: dictionary with keys tp, fp, tn, fn, acc, sp, p, r, dice, iou
+    summary: dictionary with keys 'micro' and 'macro'. 'micro' holds the summed tp, fp, tn, fn
+             and the metrics calculated from them. 'macro' holds the mean of per-sample metrics.
+    """
+    ep = 1e-6
+    
+    case_1a = gt_empty & pred_empty
+    case_1b = gt_empty & ~pred_empty
+    
+    # Case II: normal way
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acc = ((tp + tn)/(tp + tn + fn + fp))*100  
+        sp = (tn/(tn + fp + ep))*100
+        p = (tp/(tp + fp + ep))*100
+        r = (tp/(tp + fn + ep))*100
+        dice = (2 * tp / (2 * tp + fp + fn))*100
+        iou = (tp/(tp + fp + fn + ep)) * 100
+    metrics = [acc, sp, p, r, dice, iou]
+    
+    # Case I.a: all metrics are 100, and all pixels are true negatives
+    for m in metrics: m[case_1a] = 100
+    tp, fp, tn, fn = [np.array(c, dtype=np.int64) for c in (tp, fp, tn, fn)]
+    tn[case_1a] = (tp + fp + tn + fn)[case_1a]
+    tp[case_1a], fp[case_1a], fn[case_1a] = 0, 0, 0
+    
+    # Case I.b
+    if HARD_LINE:
+        for m in metrics: m[case_1b] = 0
+    else:
+        # Background is considered as y_true. itn and ifp are 0.
+        acc[case_1b] = (itp/(itp + ifn))*100
+        sp[case_1b] = 0
+        p[case_1b] = (itp/(itp + ep))*100
+        r[case_1b] = (itp/(itp + ifn + ep))*100
+        dice[case_1b] = 0
+        iou[case_1b] = (itp/(itp + ifn + ep))*100
+    
+    per_sample = {'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn,
+                  'acc': acc, 'sp': sp, 'p': p, 'r': r, 'dice': dice, 'iou': iou}
+    
+    # Micro average: metrics from the summed confusion matrix
+    stp, sfp, stn, sfn = tp.sum(), fp.sum(), tn.sum(), fn.sum()
+    micro = {'tp': stp, 'fp': sfp, 'tn': stn, 'fn': sfn,
+             'acc': ((stp + stn)/(stp + stn + sfn + sfp))*100,
+             'sp': (stn/(stn + sfp + ep))*100,
+             'p': (stp/(stp + sfp + ep))*100,
+             'r': (stp/(stp + sfn + ep))*100,
+             'dice': (2 * stp / (2 * stp + sfp + sfn + ep))*100,
+             'iou': (stp/(stp + sfp + sfn + ep)) * 100}
+    
+    # Macro average: mean of per-sample metrics
+    macro = {k: np.nanmean(per_sample[k]) for k in ['acc', 'sp', 'p', 'r', 'dice', 'iou']}
+    
+    return per_sample, {'micro': micro, 'macro': macro}
+
+def evaluate_binary_chunked(gt, pred, HARD_LINE:bool=True, slab_size:int=32, n_threads:int=1):
+    """
+    It evaluates huge binary volumes chunk by chunk, with constant memory. It gives the 
+    same outputs as evaluate_binary.
+    
+    Volumes are read slab by slab along the first (non-single) axis, in a single pass. 
+    tp, fp, tn, fn are accumulated over the slabs, so no full copy of the volumes is made. 
+    
+    Inputs
+    --------
+    gt: Ground truth volume. A numpy array, a np.memmap, or the path of a .npy file, which
+        is opened as a memory map.
+    pred: Predicted volume. Same types as gt.
+    HARD_LINE: (bool) Same as in evaluate_binary
+    slab_size: (int) No. of slices per slab
+    n_threads: (int) No. of threads that process slabs in parallel
+    
+    Return
+    --------
+    tp, fp, tn, fn, acc, sp, p, r, dice, iou
+    """
+    if isinstance(gt, str): gt = np.load(gt, mmap_mode='r')
+    if isinstance(pred, str): pred = np.load(pred, mmap_mode='r')
+    
+    # Remove single axis. These are views, no data is read.
+    gt = np.squeeze(gt)
+    pred = np.squeeze(pred)
+    assert gt.shape == pred.shape, 'Shapes of gt and pred are not equal'
+    
+    gt = np.atleast_1d(gt)
+    pred = np.atleast_1d(pred)
+    starts = range(0, gt.shape[0], slab_size)
+    
+    def run(fn):
+        if n_threads > 1:
+            with ThreadPoolExecutor(n_threads) as ex: return list(ex.map(fn, starts))
+        return [fn(s) for s in starts]
+    
+    # One pass: each slab is counted with its own foreground value (its max)
+    def slab_counts(s):
+        g = np.asarray(gt[s:s+slab_size])
+        p = np.asarray(pred[s:s+slab_size])
+        hi = max(g.max(), p.max())
+        fg_mask = g == hi
+        fg_pred = p == hi
+        return (hi, np.count_nonzero(np.logical_and(fg_mask, fg_pred)), np.count_nonzero(fg_mask),
+                np.count_nonzero(fg_pred), np.count_nonzero(g), np.count_nonzero(p))
+    
+    counts = run(slab_counts) if gt.size else []
+    
+    # Foreground value of the volume, as in confusion_binary. A slab with a smaller max
+    # has no pixel of that value, so its tp, n_mask and n_pred are 0. No re-reading is needed.
+    hi = max(c[0] for c in counts) if counts else 0
+    counts = np.array([c[1:] if c[0] == hi else (0, 0, 0) + c[4:] for c in counts], dtype=np.int64).reshape(-1, 5)
+    tp, n_mask, n_pred, n_gt_nonzero, n_pred_nonzero = counts.sum(axis=0)
+    
+    fp = n_pred - tp
+    fn = n_mask - tp
+    tn = gt.size - tp - fp - fn
+    
+    return binary_metrics((np.int64(tn), np.int64(fp), np.int64(fn), np.int64(tp)), 
+                          n_gt_nonzero == 0, n_pred_nonzero, HARD_LINE)
+
+def evaluate_binary_batch(gt_stack, pred_stack, HARD_LINE:bool=True):
+    """
+    It evaluates a stack of binary images at once. Per-sample metrics are calculated 
+    with axis reductions, and Case I.a / I.b / II of evaluate_binary are applied with
+    masks, so there is no python loop over the samples. 
+    
+    The foreground value is the maximum value of both stacks (e.g. 1 or 255).
+    
+    Inputs
+    --------
+    gt_stack: (array: NxHxW or NxHxWx1) Ground truth images
+    pred_stack: (array: NxHxW or NxHxWx1) Predicted images
+    HARD_LINE: (bool) Same as in evaluate_binary
+    
+    Return
+    --------
+    per_sample: dictionary with keys tp, fp, tn, fn, acc, sp, p, r, dice, iou. Each value 
+                is an array with one entry per sample, same as evaluate_binary gives.
+    summary: dictionary with keys 'micro' and 'macro'. 'micro' holds the summed tp, fp, tn, fn
+             and the metrics calculated from them. 'macro' holds the mean of per-sample metrics.
+    """
+    n_samples = len(gt_stack)
+    flat_mask = np.reshape(gt_stack, (n_samples, -1))
+    flat_pred = np.reshape(pred_stack, (n_samples, -1))
+    n_pix = flat_mask.shape[1]
+    
+    # Foreground value
+    hi = max(flat_mask.max(), flat_pred.max()) if flat_mask.size else 0
+    fg_mask = flat_mask == hi
+    fg_pred = flat_pred == hi
+    
+    # Confusion matrix of each sample
+    tp = np.count_nonzero(np.logical_and(fg_mask, fg_pred), axis=1).astype(np.int64)
+    fp = np.count_nonzero(fg_pred, axis=1) - tp
+    fn = np.count_nonzero(fg_mask, axis=1) - tp
+    tn = n_pix - tp - fp - fn
+    
+    # Case masks
+    gt_empty = np.logical_not(flat_mask.any(axis=1)) # Case I
+    pred_empty = np.logical_not(flat_pred.any(axis=1)) 
+    
+    # Counted values of the inverted GT for Case I.b
+    itp = n_pix - np.count_nonzero(flat_pred[gt_empty & ~pred_empty], axis=1)
+    ifn = n_pix - itp
+    
+    return binary_metrics_batch(tp, fp, tn, fn, gt_empty, pred_empty, itp, ifn, HARD_LINE)
+
+def check_evaluate_binary_batch(gt_stack, pred_stack, HARD_LINE:bool=True):
+    """
+    It checks that evaluate_binary_batch gives the same per-sample outputs as calling 
+    evaluate_binary on each sample. An AssertionError names the first mismatching sample.
+    """
+    per_sample, _ = evaluate_binary_batch(gt_stack, pred_stack, HARD_LINE)
+    keys = ['tp', 'fp', 'tn', 'fn', 'acc', 'sp', 'p', 'r', 'dice', 'iou']
+    for i in range(len(gt_stack)):
+        ref = evaluate_binary(gt_stack[i], pred_stack[i], HARD_LINE)
+        for k, v in zip(keys, ref):
+            assert np.isclose(per_sample[k][i], v, equal_nan=True), 'sample %d: %s is %s, expected %s' % (i, k, per_sample[k][i], v)
+
+def evaluate_binary_sklearn(gt, pred, HARD_LINE:bool=True):
+    # Reference implementation of evaluate_binary based on sklearn's confusion_matrix.
+    # It is slower, and only used when evaluate_binary is called with fast=False.
+    from sklearn.metrics import confusion_matrix
     
     # Remove single axis
     gt = np.squeeze(gt)
@@ -124,10 +427,225 @@ if __name__ == "__main__":
     pred = cv2.imread(os.path.join(dir_pred, name), 0) # read prediction
     
     tp, fp, tn, fn, acc, sp, p, r, dice, iou = evaluate_binary(gt_mask, pred, HARD_LINE=True)
+    
+    # Batch evaluation must match evaluate_binary, including all-black samples
+    rng = np.random.default_rng(0)
+    gt_stack = (rng.random((8, 32, 32)) > 0.7).astype(np.uint8) * 255
+    pred_stack = (rng.random((8, 32, 32)) > 0.7).astype(np.uint8) * 255
+    gt_stack[:3], pred_stack[::3] = 0, 0
+    for HARD_LINE in [True, False]:
+        check_evaluate_binary_batch(gt_stack, pred_stack, HARD_LINE)
+        check_evaluate_binary_batch(np.zeros_like(gt_stack), np.zeros_like(pred_stack), HARD_LINE)
 
 
 # =============================== End of evaluate_binary =============================== #
 
+# =============================== Start of evaluate_dataset ============================= #
+"""
+It evaluates all label/prediction pairs of two directories with evaluate_binary.
+
+Images are read and decoded by a thread pool, and pairs are scored by a process pool, 
+a chunk at a time, so memory stays bounded. Per-image rows are appended to a CSV file as 
+soon as they are scored. Each row stores a content hash of the label and the prediction 
+files. On a re-run, pairs whose hash did not change are taken from the CSV, and only the 
+new or changed pairs are scored. An interrupted run can be resumed the same way.
+
+Inputs
+------------
+    dir_gt: (str) Directory of ground truth images
+    dir_pred: (str) Directory of predicted images. Files must have the same names as in dir_gt.
+    out_csv: (str) CSV file of per-image results. It also works as the results cache.
+    HARD_LINE: (bool) Same as in evaluate_binary
+    n_workers: (int) No. of scoring processes. None uses os.cpu_count(). 0 scores in the main process.
+    n_readers: (int) No. of image reading threads
+    chunk_size: (int) No. of pairs that are read and scored at a time
+    parquet_path: (str) If given, the final table is also written to a parquet file (needs pandas)
+    verbose: (bool) whether to allow printing
+
+Outputs
+------------
+    rows: a dictionary {name: row}, where row is a dictionary with keys 
+          name, hash, tp, fp, tn, fn, acc, sp, p, r, dice, iou
+          Pairs that cannot be decoded as images are skipped and not included.
+
+Example
+------------
+    rows = evaluate_dataset('./labels', './predictions', './results.csv', HARD_LINE=True)
+"""
+import os
+import csv
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+RESULT_FIELDS = ['name', 'hash', 'tp', 'fp', 'tn', 'fn', 'acc', 'sp', 'p', 'r', 'dice', 'iou']
+
+def read_results(out_csv):
+    """ 
+    It reads a results CSV written by evaluate_dataset. If a name appears more than once, 
+    the last row is kept.
+    """
+    rows = {}
+    if os.path.isfile(out_csv):
+        with open(out_csv, 'r', newline='') as f:
+            for row in csv.DictReader(f): 
+                rows[row['name']] = {k: (v if k in ['name', 'hash'] else float(v)) for k, v in row.items()}
+    return rows
+
+def read_pair(dir_gt, dir_pred, name, cached_hash=None, HARD_LINE:bool=True):
+    """ 
+    It reads a label/prediction pair and hashes the file contents (and HARD_LINE, as it 
+    changes the results). Images are decoded only if the hash differs from cached_hash. 
+    It returns (name, hash, gt, pred, cache_hit). On a cache hit, gt and pred are None. 
+    If a file cannot be decoded as an image, the corresponding image is None.
+    """
+    import cv2
+    
+    with open(os.path.join(dir_gt, name), 'rb') as f: gt_bytes = f.read()
+    with open(os.path.join(dir_pred, name), 'rb') as f: pred_bytes = f.read()
+    
+    h = hashlib.blake2b(gt_bytes, digest_size=16)
+    h.update(pred_bytes)
+    h.update(b'HARD_LINE' if HARD_LINE else b'SOFT_LINE')
+    h = h.hexdigest()
+    
+    if h == cached_hash: return name, h, None, None, True
+    
+    gt = cv2.imdecode(np.frombuffer(gt_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    pred = cv2.imdecode(np.frombuffer(pred_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    
+    return name, h, gt, pred, False
+
+def evaluate_dataset(dir_gt, dir_pred, out_csv, HARD_LINE:bool=True, n_workers=None, 
+                     n_readers:int=4, chunk_size:int=256, parquet_path=None, verbose:bool=True):
+    
+    # Pairs of files that exist in both directories (sub-directories are skipped)
+    names = sorted(n for n in set(os.listdir(dir_gt)) & set(os.listdir(dir_pred))
+                   if os.path.isfile(os.path.join(dir_gt, n)) and os.path.isfile(os.path.join(dir_pred, n)))
+    
+    cached = read_results(out_csv)
+    rows = {}
+    n_scored = 0
+    skipped = []
+    
+    new_file = not os.path.isfile(out_csv)
+    f = open(out_csv, 'a', newline='')
+    writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+    if new_file: writer.writeheader()
+    
+    pool = ProcessPoolExecutor(n_workers) if n_workers != 0 else None
+    
+    try:
+        with ThreadPoolExecutor(n_readers) as readers:
+            for start in range(0, len(names), chunk_size):
+                chunk = names[start:start+chunk_size]
+                
+                # Read and decode the chunk in threads
+                pairs = readers.map(lambda n: read_pair(dir_gt, dir_pred, n, cached.get(n, {}).get('hash'), HARD_LINE), chunk)
+                
+                # Score changed pairs in processes. Unchanged pairs are taken from the cache.
+                jobs = []
+                for name, h, gt, pred, hit in pairs:
+                    if hit: 
+                        rows[name] = cached[name]
+                    elif gt is None or pred is None:
+                        skipped.append(name) # not an image, or a corrupt one
+                    elif pool is None:
+                        jobs.append((name, h, evaluate_binary(gt, pred, HARD_LINE)))
+                    else:
+                        jobs.append((name, h, pool.submit(evaluate_binary, gt, pred, HARD_LINE)))
+                
+                for name, h, job in jobs:
+                    out = job if pool is None else job.result()
+                    row = dict(zip(RESULT_FIELDS, [name, h] + [float(v) for v in out]))
+                    writer.writerow(row)
+                    rows[name] = row
+                    n_scored += 1
+                f.flush() # results of this chunk are safe on disk
+                
+                if verbose: print('Evaluated %d/%d' % (min(start+chunk_size, len(names)), len(names)))
+    finally:
+        f.close()
+        if pool is not None: pool.shutdown()
+    
+    # Compact the CSV: one row per current pair
+    tmp = out_csv + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for name in sorted(rows): writer.writerow(rows[name])
+    os.replace(tmp, out_csv)
+    
+    if parquet_path is not None:
+        import pandas as pd
+        df = pd.read_csv(out_csv)
+        df.to_parquet(parquet_path, index=False)
+    
+    if verbose: 
+        print('Scored %d pairs, %d taken from cache' % (n_scored, len(rows) - n_scored))
+        if skipped: print('Skipped %d pairs that could not be decoded: %s' % (len(skipped), ', '.join(skipped)))
+    
+    return rows
+
+# ================================ End of evaluate_dataset ============================== #
+
+# ============================= Start of evaluate_multiclass ============================ #
+"""
+It evaluates multi-class segmentation. The K x K confusion matrix is built in a single pass
+over the image, and per-class metrics are derived from it. It works for 2D and 3D inputs.
+
+Inputs
+------------
+    gt: (array: HxW, HxWx1 or HxWxD) Ground truth with integer class labels 0, 1, ..., num_classes-1.
+        Labels outside this range raise a ValueError.
+    pred: (array: same size as gt) Prediction with integer class labels
+    num_classes: (int) No. of classes, K
+    HARD_LINE: (bool) Per-class version of evaluate_binary's HARD_LINE. If a class is not 
+               present in GT but present in the prediction, then its metrics are set to 0. 
+               If False, then pixels that are not of that class are considered as y_true.
+               If a class is present in neither GT nor prediction, its metrics are set to 100.
+
+Outputs
+------------
+    cm: K x K confusion matrix. Rows are GT classes, columns are predicted classes.
+    per_class: dictionary with keys tp, fp, tn, fn, acc, sp, p, r, dice, iou. Each value is 
+               an array of K entries.
+    summary: dictionary with keys 'micro' and 'macro'. 'micro' metrics are calculated from the 
+             summed tp, fp, tn, fn of all classes. 'macro' is the mean of per-class metrics.
+"""
+def evaluate_multiclass(gt, pred, num_classes:int, HARD_LINE:bool=True):
+    
+    K = num_classes
+    
+    flat_mask = np.ravel(np.squeeze(gt))
+    flat_pred = np.ravel(np.squeeze(pred))
+    
+    if flat_mask.size and (flat_mask.min() < 0 or flat_mask.max() >= K):
+        raise ValueError('gt labels must be in 0..%d' % (K-1))
+    if flat_pred.size and (flat_pred.min() < 0 or flat_pred.max() >= K):
+        raise ValueError('pred labels must be in 0..%d' % (K-1))
+    
+    # Confusion matrix in one pass
+    idx = flat_mask.astype(np.int64) * K + flat_pred
+    cm = np.bincount(idx, minlength=K*K).reshape(K, K)
+    
+    n_pix = flat_mask.size
+    tp = np.diag(cm).copy()
+    fp = cm.sum(axis=0) - tp
+    fn = cm.sum(axis=1) - tp
+    tn = n_pix - tp - fp - fn
+    
+    gt_empty = (tp + fn) == 0
+    pred_empty = (tp + fp) == 0
+    
+    # Pixels that are not of that class are considered as y_true for Case I.b
+    case_1b = gt_empty & ~pred_empty
+    per_class, summary = binary_metrics_batch(tp, fp, tn, fn, gt_empty, pred_empty, 
+                                              tn[case_1b], fp[case_1b], HARD_LINE)
+    
+    return cm, per_class, summary
+
+# ============================== End of evaluate_multiclass ============================= #
+
 # ================================== Start of iouOBB =================================== #
 """
 This code calculates IoU between two oriented rectangular bounding boxes.
@@ -158,11 +676,198 @@ def union_area(rect1, rect2):
     return poly_union.area
 
 def iouOBB(rect1, rect2):
-    intersection = intersection_area(rect1, rect2)
-    union = union_area(rect1, rect2)
+    # Build each polygon once. As both boxes are convex, union = area1 + area2 - intersection.
+    poly1 = Polygon(rect1)
+    poly2 = Polygon(rect2)
+    intersection = poly1.intersection(poly2).area if poly1.intersects(poly2) else 0.0
+    union = poly1.area + poly2.area - intersection
     
     return intersection / union
 
+def polygon_area(polys):
+    """Signed shoelace area of (..., V, 2) polygons. Positive for counter-clockwise vertices."""
+    x, y = polys[..., 0], polys[..., 1]
+    return 0.5 * np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1)
+
+def convex_intersection_area(poly1, poly2):
+    """
+    Calculate the intersection areas of P pairs of convex quadrilaterals, poly1[k] and 
+    poly2[k], with numpy. Both inputs are (P, 4, 2) arrays with counter-clockwise vertices.
+    
+    The intersection polygon is the convex hull of the vertices of one box that are inside
+    the other box, plus the edge-edge crossings. These candidate points (at most 24) are 
+    sorted by angle around their centroid, and the area is calculated with the shoelace formula.
+    """
+    ep = 1e-9
+    P = len(poly1)
+    
+    def inside(pts, poly):
+        # pts: (P, n, 2), poly: (P, 4, 2). A point is inside if it is on the left of all edges.
+        edge = np.roll(poly, -1, axis=1) - poly # (P, 4, 2)
+        rel = pts[:, :, None, :] - poly[:, None, :, :] # (P, n, 4, 2)
+        cross = edge[:, None, :, 0] * rel[..., 1] - edge[:, None, :, 1] * rel[..., 0]
+        return np.all(cross >= -ep, axis=2)
+    
+    # Vertices of one box inside the other
+    in1 = inside(poly1, poly2)
+    in2 = inside(poly2, poly1)
+    
+    # Edge-edge crossings: a + t*da = b + u*db
+    a, da = poly1, np.roll(poly1, -1, axis=1) - poly1
+    b, db = poly2, np.roll(poly2, -1, axis=1) - poly2
+    a, da = a[:, :, None, :], da[:, :, None, :] # (P, 4, 1, 2)
+    b, db = b[:, None, :, :], db[:, None, :, :] # (P, 1, 4, 2)
+    denom = da[..., 0] * db[..., 1] - da[..., 1] * db[..., 0] # (P, 4, 4)
+    ab = b - a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (ab[..., 0] * db[..., 1] - ab[..., 1] * db[..., 0]) / denom
+        u = (ab[..., 0] * da[..., 1] - ab[..., 1] * da[..., 0]) / denom
+        cross_pts = (a + t[..., None] * da).reshape(P, 16, 2)
+    valid_x = (np.abs(denom) > ep) & (t >= -ep) & (t <= 1 + ep) & (u >= -ep) & (u <= 1 + ep)
+    
+    pts = np.concatenate([poly1, poly2, cross_pts], axis=1) # (P, 24, 2)
+    valid = np.concatenate([in1, in2, valid_x.reshape(P, 16)], axis=1)
+    pts = np.where(valid[..., None], pts, 0.0)
+    n_valid = valid.sum(axis=1)
+    
+    # Sort valid points by angle around their centroid. Invalid points go to the end.
+    centroid = pts.sum(axis=1) / np.maximum(n_valid, 1)[:, None]
+    rel = pts - centroid[:, None, :]
+    angle = np.where(valid, np.arctan2(rel[..., 1], rel[..., 0]), np.inf)
+    order = np.argsort(angle, axis=1)
+    pts = np.take_along_axis(pts, order[..., None], axis=1)
+    
+    # Replace the invalid tail by the first point. It adds nothing to the shoelace sum.
+    tail = np.arange(pts.shape[1])[None, :] >= n_valid[:, None]
+    pts = np.where(tail[..., None], pts[:, :1, :], pts)
+    
+    area = np.abs(polygon_area(pts))
+    area[n_valid < 3] = 0.0
+    
+    # Tolerant vertex tests can count a vertex twice for nearly identical boxes. 
+    # The intersection can not be larger than the smaller box.
+    return np.minimum(area, np.minimum(np.abs(polygon_area(poly1)), np.abs(polygon_area(poly2))))
+
+def iouOBB_matrix(boxes_a, boxes_b, chunk_size:int=100000):
+    """
+    Calculate the IoU matrix between two sets of oriented rectangular bounding boxes.
+    
+    Input
+    --------
+    boxes_a: (N, 4, 2) array of box corners, in clockwise or counter-clockwise order
+    boxes_b: (M, 4, 2) array of box corners
+    chunk_size: max no. of box pairs processed at a time
+    
+    Return
+    --------
+    iou: (N, M) IoU matrix. It gives the same values as iouOBB, without shapely.
+    """
+    boxes_a = np.asarray(boxes_a, dtype=float).reshape(-1, 4, 2)
+    boxes_b = np.asarray(boxes_b, dtype=float).reshape(-1, 4, 2)
+    
+    # Make vertices counter-clockwise
+    area_a = polygon_area(boxes_a)
+    area_b = polygon_area(boxes_b)
+    boxes_a = np.where((area_a < 0)[:, None, None], boxes_a[:, ::-1], boxes_a)
+    boxes_b = np.where((area_b < 0)[:, None, None], boxes_b[:, ::-1], boxes_b)
+    area_a, area_b = np.abs(area_a), np.abs(area_b)
+    
+    iou = np.zeros((len(boxes_a), len(boxes_b)))
+    
+    # Axis-aligned bounding box prefilter. Only overlapping envelopes are clipped.
+    min_a, max_a = boxes_a.min(axis=1), boxes_a.max(axis=1)
+    min_b, max_b = boxes_b.min(axis=1), boxes_b.max(axis=1)
+    overlap = np.all((min_a[:, None] <= max_b[None]) & (min_b[None] <= max_a[:, None]), axis=2)
+    ia, ib = np.nonzero(overlap)
+    
+    for start in range(0, len(ia), chunk_size):
+        ca, cb = ia[start:start+chunk_size], ib[start:start+chunk_size]
+        inter = convex_intersection_area(boxes_a[ca], boxes_b[cb])
+        union = area_a[ca] + area_b[cb] - inter
+        with np.errstate(divide='ignore', invalid='ignore'):
+            iou[ca, cb] = np.clip(np.where(union > 0, inter / union, 0.0), 0.0, 1.0)
+    
+    return iou
+
+def nms_obb(boxes, scores, iou_thr:float=0.5, chunk_size:int=100000):
+    """
+    Non-maximum suppression of oriented rectangular bounding boxes.
+    
+    An STR-tree over the axis-aligned envelopes of the boxes finds, for each box, the boxes 
+    whose envelopes overlap its own, so only those pairs are compared. The candidate pairs are
+    streamed in chunks, and their IoUs are calculated at once with convex_intersection_area
+    and the cached box areas. Then boxes are visited in descending order of score, and each 
+    kept box suppresses its neighbours with IoU > iou_thr.
+    
+    Input
+    --------
+    boxes: (N, 4, 2) array of box corners
+    scores: (N,) array of box scores
+    iou_thr: boxes that overlap a higher scoring kept box by more than this are removed
+    chunk_size: max no. of box pairs processed at a time
+    
+    Return
+    --------
+    keep: indices of the kept boxes, in descending order of score
+    """
+    import shapely
+    from shapely.strtree import STRtree
+    
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4, 2)
+    scores = np.asarray(scores, dtype=float)
+    N = len(boxes)
+    if N == 0: return np.zeros(0, dtype=np.int64)
+    
+    # Counter-clockwise vertices and cached areas
+    area = polygon_area(boxes)
+    boxes = np.where((area < 0)[:, None, None], boxes[:, ::-1], boxes)
+    area = np.abs(area)
+    
+    # Spatial index over envelopes. Each box is queried with its own envelope, so a 
+    # large box does not widen the search of the others.
+    lo, hi = boxes.min(axis=1), boxes.max(axis=1)
+    envelopes = shapely.box(lo[:, 0], lo[:, 1], hi[:, 0], hi[:, 1])
+    tree = STRtree(envelopes)
+    
+    # Stream the candidate pairs and keep only those with IoU > iou_thr
+    hit_a, hit_b = [], []
+    n_query = max(1, chunk_size // 100)
+    for q in range(0, N, n_query):
+        ia, ib = tree.query(envelopes[q:q+n_query], predicate='intersects')
+        ia = ia + q
+        upper = ia < ib # each pair once
+        ia, ib = ia[upper], ib[upper]
+        
+        for start in range(0, len(ia), chunk_size):
+            ca, cb = ia[start:start+chunk_size], ib[start:start+chunk_size]
+            inter = convex_intersection_area(boxes[ca], boxes[cb])
+            union = area[ca] + area[cb] - inter
+            with np.errstate(divide='ignore', invalid='ignore'):
+                iou = np.where(union > 0, inter / union, 0.0)
+            hit = iou > iou_thr
+            hit_a.append(ca[hit]); hit_b.append(cb[hit])
+    
+    ia = np.concatenate(hit_a).astype(np.int64) if hit_a else np.zeros(0, dtype=np.int64)
+    ib = np.concatenate(hit_b).astype(np.int64) if hit_b else np.zeros(0, dtype=np.int64)
+    
+    # Neighbour lists (both directions) of the overlapping pairs, in CSR format
+    src = np.concatenate([ia, ib])
+    dst = np.concatenate([ib, ia])
+    srt = np.argsort(src, kind='stable')
+    dst = dst[srt]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=N))])
+    
+    # Greedy suppression
+    order = np.argsort(-scores, kind='stable')
+    suppressed = np.zeros(N, dtype=bool)
+    keep = []
+    for i in order:
+        if suppressed[i]: continue
+        keep.append(i)
+        suppressed[dst[offsets[i]:offsets[i+1]]] = True
+    
+    return np.array(keep, dtype=np.int64)
+
 def plot_oriented_rectangles(rect1, rect2):
     """Plot the two oriented rectangles and their overlapping area."""
     fig, ax = plt.subplots()
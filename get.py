@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
 import numpy as np
 import os
+import json
+import shutil
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
 import pydicom
+from concurrent.futures import ThreadPoolExecutor
 
 #%% get_dcm
 """
@@ -20,62 +27,383 @@ Created on Fri May  7 08:06:50 2021
 @author: mrinal
 """
 # Read dicom
-def get_dcm(dcm_path):
+def get_dcm(dcm_path, n_workers=None):
+    sorted_files, pix_dim, pix_spacing = get_dcm_series(dcm_path, n_workers)
+    
+    return read_dcm_files(sorted_files, pix_dim, pix_spacing, n_workers)
+
+# Decode sorted dicom files into a volume
+def read_dcm_files(sorted_files, pix_dim, pix_spacing, n_workers=None):
+    with ThreadPoolExecutor(n_workers) as pool:
+        # Decode the first slice to get the data type, then decode the rest in parallel
+        # directly into the volume
+        first = pydicom.dcmread(sorted_files[0]).pixel_array
+        dcm_data = np.zeros(pix_dim, dtype=first.dtype)
+        dcm_data[:, :, 0] = first
+        
+        def read_slice(idx):
+            dcm_data[:, :, idx] = pydicom.dcmread(sorted_files[idx]).pixel_array
+        
+        list(pool.map(read_slice, range(1, len(sorted_files))))
+    
+    # Get the min and max intensity
+    intensity = (dcm_data.min(), dcm_data.max())
+        
+    return dcm_data, pix_spacing, intensity
+
+#%% get_dcm_series
+'''
+* 'get_dcm_series' finds the dicom files of a directory and sorts them the way get_dcm does.
+  Only headers are read (no pixel data), once per file, in parallel.
+* Input parameter:
+    dcm_path: location of dcm data
+    n_workers: no. of reading threads
+    
+* Output:
+    Returns - 
+       - sorted_files: file paths, in the slice order of the volume
+       - pix_dim: volume shape (rows, columns, slices)
+       - pix_spacing: spacing of pixel/voxel
+'''
+def get_dcm_series(dcm_path, n_workers=None):
     dicom_img = []
-    file_names = []
     # Get DICOM image names
     for dir_name, sub_dir_list, file_list in os.walk(dcm_path):
         for file_name in file_list:
             if ".dcm" in file_name.lower():  # check whether the file's DICOM  
-                dcm_dir = dir_name
-                file_names.append(file_name)
                 dicom_img.append(os.path.join(dir_name,file_name))
     
+    # Read headers only (no pixel data), once per file
+    with ThreadPoolExecutor(n_workers) as pool:
+        headers = list(pool.map(lambda f: pydicom.dcmread(f, stop_before_pixels=True), dicom_img))
+    
     # Get ref file
-    ref = pydicom.dcmread(dicom_img[0])    
+    ref = headers[0]
     # Get the spacing
     pix_dim = (int(ref.Rows), int(ref.Columns), len(dicom_img))
     # Get spacing values (in mm)
     pix_spacing = (float(ref.PixelSpacing[0]), float(ref.PixelSpacing[1]), float(ref.SliceThickness))    
-    # Get the data
-    dcm_data = np.zeros(pix_dim, dtype=ref.pixel_array.dtype)   
 
     # Check if the DICOM file has 'SliceLocation' attribute. It if it has, then store them
     # according to the slice location. Otherwise, store them chronologically. 
-    if hasattr(pydicom.dcmread(dicom_img[0]), 'ImagePositionPatient'):               
+    if hasattr(ref, 'ImagePositionPatient'):               
         # Sort file names according to the slice location
-        sliceLocation = [pydicom.dcmread(dicom_img[i]).ImagePositionPatient[-1] for i in range(len(dicom_img))]
+        sliceLocation = [h.ImagePositionPatient[-1] for h in headers]
         ps = list(np.argsort(sliceLocation)) #ps: position of the sorted slice locations
         ps.reverse() #slices will be sorted in descending order
-        sorted_file_names = [file_names[ps[i]] for i in range(len(ps))]
-#        print('DICOM sorted by slice location: \n', sorted_file_names)
+        sorted_files = [dicom_img[i] for i in ps]
         print('DICOM sorted by ImagePositionPatient')          
-        
-        # loop through all the DICOM files
-        idx = 0
-        for file in sorted_file_names:       
-            # read the file
-            ds = pydicom.dcmread(os.path.join(dcm_dir,file))
-            # store the raw image data
-            dcm_data[:, :, idx] = ds.pixel_array
-            idx += 1
     else:
         print('No slice location. DICOM sorted chronologically')
-#        dicom_img_reverse = dicom_img.copy()
-#        dicom_img_reverse.reverse()
-        dicom_img.reverse() # slices will be sorted in descending order
-        # loop through all the DICOM files
-        for file in dicom_img:
-            # read the file
-            ds = pydicom.dcmread(os.path.join(dcm_dir,file))
-            # store the raw image data
-            dcm_data[:, :, dicom_img.index(file)] = ds.pixel_array                              
+        sorted_files = dicom_img[::-1] # slices will be sorted in descending order
     
-    # Get the min and max intensity
-    intensity = (dcm_data.min(), dcm_data.max())
+    return sorted_files, pix_dim, pix_spacing
+
+#%% LazyDicomVolume
+'''
+* 'LazyDicomVolume' opens a dicom series without decoding it. It has the same shape, dtype and
+  spacing that get_dcm reports, and supports numpy-style slicing. Slices (along the 3rd axis) 
+  are decoded on demand and kept in an LRU cache of at most 'max_slices' slices, so opening
+  a series is fast and memory stays bounded.
+* Input parameter:
+    dcm_path: location of dcm data
+    max_slices: max no. of decoded slices kept in memory
+    n_workers: no. of reading threads
+
+Example
+========
+vol = LazyDicomVolume(r'./dicom', max_slices=32)
+print(vol.shape, vol.dtype, vol.pix_spacing)
+crop = vol[100:164, 200:264, 50:60] # only 10 slices are decoded
+d = np.asarray(vol) # whole volume, same as get_dcm
+'''
+class LazyDicomVolume():
+    
+    def __init__(self, dcm_path, max_slices=64, n_workers=None):
+        self.files, self.shape, self.pix_spacing = get_dcm_series(dcm_path, n_workers)
+        self.max_slices = max_slices
+        self.n_workers = n_workers
+        self.ndim = 3
+        
+        self._cache = OrderedDict() # slice index -> decoded slice, in LRU order
+        self._lock = threading.Lock()
+        
+        self.dtype = self.get_slice(0).dtype # decode one slice to get the data type
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def get_slice(self, idx):
+        '''
+        Decoded slice dcm_data[:, :, idx]. It is the cached array itself, so it is read-only.
+        '''
+        with self._lock:
+            if idx in self._cache:
+                self._cache.move_to_end(idx)
+                return self._cache[idx]
+        
+        data = pydicom.dcmread(self.files[idx]).pixel_array
+        data.setflags(write=False) # callers must not change the cached slice
+        
+        with self._lock:
+            self._cache[idx] = data
+            self._cache.move_to_end(idx)
+            while len(self._cache) > self.max_slices: self._cache.popitem(last=False)
+        return data
+    
+    def __getitem__(self, key):
+        if not isinstance(key, tuple): key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = [k is Ellipsis for k in key].index(True)
+            key = key[:i] + (slice(None),) * (3 - len(key) + 1) + key[i+1:]
+        key = key + (slice(None),) * (3 - len(key))
+        
+        z = np.arange(self.shape[2])[key[2]] # slice indices to decode
+        if np.ndim(z) == 0: return self.get_slice(int(z))[key[0], key[1]].copy()
+        
+        with ThreadPoolExecutor(self.n_workers) as pool:
+            slices = list(pool.map(lambda i: self.get_slice(int(i))[key[0], key[1]], z))
+        
+        if len(slices) == 0: 
+            return np.zeros(np.zeros(self.shape[:2])[key[0], key[1]].shape + (0,), self.dtype)
+        return np.stack(slices, axis=-1)
+    
+    def __array__(self, dtype=None, copy=None):
+        data = self[:, :, :]
+        return data if dtype is None else data.astype(dtype)
+    
+    def intensity(self):
+        '''
+        Min and max intensity, same as get_dcm. All slices are decoded, one at a time.
+        '''
+        mins, maxs = zip(*[(s.min(), s.max()) for s in map(self.get_slice, range(self.shape[2]))])
+        return min(mins), max(maxs)
+    
+    def __repr__(self):
+        return 'LazyDicomVolume(shape=%s, dtype=%s, pix_spacing=%s)' % (self.shape, self.dtype, self.pix_spacing)
+
+
+#%% get_dcm_cached
+'''
+* 'get_dcm_cached' is get_dcm with a persistent on-disk cache. Each decoded series is stored once
+  in cache_dir as a memory-mappable .npy array plus a small json file with its spacing and 
+  intensity. Later loads map the cached array instead of parsing the dicom files again.
+* The cache key is a fingerprint of the dicom file paths, sizes and modification times, so 
+  a changed series is decoded again. Only file system metadata is read to compute it.
+* If max_cache_gb is given, least recently used entries are evicted to keep the cache under it.
+* Input parameter:
+    dcm_path: location of dcm data
+    cache_dir: location of the cache
+    max_cache_gb: max size of the cache in GB. None means no limit.
+    mmap: if True, the cached array is returned as a copy-on-write memory map, so it can be
+          modified in memory (e.g. by scale_intensity) without changing the cache. Otherwise 
+          it is loaded into memory.
+    n_workers: no. of reading threads of get_dcm
+    
+* Output: same as get_dcm
+
+Example
+========
+d, pix_spacing, intensity = get_dcm_cached(r'./dicom', r'./dcm_cache', max_cache_gb=50)
+clear_dcm_cache(r'./dcm_cache', r'./dicom') # invalidate one series
+'''
+def dcm_fingerprint(dcm_path):
+    stats = []
+    for dir_name, sub_dir_list, file_list in os.walk(dcm_path):
+        for file_name in file_list:
+            if ".dcm" in file_name.lower():
+                st = os.stat(os.path.join(dir_name, file_name))
+                stats.append('%s|%d|%d' % (os.path.relpath(os.path.join(dir_name, file_name), dcm_path), 
+                                           st.st_size, st.st_mtime_ns))
+    stats.sort()
+    h = hashlib.sha256(os.path.abspath(dcm_path).encode())
+    for s in stats: h.update(s.encode())
+    return h.hexdigest()
+
+def get_dcm_cached(dcm_path, cache_dir, max_cache_gb=None, mmap=True, n_workers=None):
+    entry = os.path.join(cache_dir, dcm_fingerprint(dcm_path))
+    data_file, meta_file = os.path.join(entry, 'data.npy'), os.path.join(entry, 'meta.json')
+    
+    if os.path.isfile(meta_file) and os.path.isfile(data_file):
+        with open(meta_file, 'r') as f: meta = json.load(f)
+        os.utime(meta_file) # mark as recently used
+        dcm_data = np.load(data_file, mmap_mode='c' if mmap else None)
+    else:
+        dcm_data, pix_spacing, intensity = get_dcm(dcm_path, n_workers)
+        meta = {'dcm_path': os.path.abspath(dcm_path), 'pix_spacing': list(pix_spacing), 
+                'intensity': [intensity[0].item(), intensity[1].item()], 
+                'shape': list(dcm_data.shape), 'dtype': str(dcm_data.dtype)}
         
+        # Write to a temporary directory first, so a partial entry is never used
+        tmp = entry + '.tmp%d' % os.getpid()
+        get_dir(tmp)
+        np.save(os.path.join(tmp, 'data.npy'), dcm_data)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f: json.dump(meta, f)
+        if os.path.isdir(entry): shutil.rmtree(entry)
+        os.replace(tmp, entry)
+        
+        if max_cache_gb is not None: evict_dcm_cache(cache_dir, max_cache_gb, keep=entry)
+        if mmap: dcm_data = np.load(data_file, mmap_mode='c')
+    
+    pix_spacing = tuple(meta['pix_spacing'])
+    intensity = tuple(np.dtype(meta['dtype']).type(v) for v in meta['intensity'])
+    
     return dcm_data, pix_spacing, intensity
 
+def evict_dcm_cache(cache_dir, max_cache_gb, keep=None):
+    '''
+    Removes least recently used cache entries until the cache is under max_cache_gb.
+    The entry 'keep' is never removed.
+    '''
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        meta_file = os.path.join(entry, 'meta.json')
+        if not os.path.isfile(meta_file): continue
+        size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+        entries.append((os.path.getmtime(meta_file), size, entry))
+    
+    total = sum(e[1] for e in entries)
+    for _, size, entry in sorted(entries): # oldest first
+        if total <= max_cache_gb * 1024**3: break
+        if entry == keep: continue
+        shutil.rmtree(entry)
+        total -= size
+
+def clear_dcm_cache(cache_dir, dcm_path=None):
+    '''
+    Removes cached entries of dcm_path (all versions of it). If dcm_path is None, the whole 
+    cache is removed.
+    '''
+    if not os.path.isdir(cache_dir): return
+    src = None if dcm_path is None else os.path.abspath(dcm_path)
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        meta_file = os.path.join(entry, 'meta.json')
+        if not os.path.isfile(meta_file): continue
+        if src is not None:
+            with open(meta_file, 'r') as f: 
+                if json.load(f)['dcm_path'] != src: continue
+        shutil.rmtree(entry)
+
+#%% index_dcm_archive
+'''
+* 'index_dcm_archive' scans a dicom archive (e.g. a PACS export with many studies and series) 
+  once, in parallel, reading headers only. For every .dcm file it records StudyInstanceUID, 
+  SeriesInstanceUID, slice position, spacing and file path in a local SQLite database.
+* On a rescan, only new or changed files (by size and modification time) are read, and 
+  removed files are deleted from the index. Files that cannot be read as dicom are skipped.
+* 'get_dcm_by_uid' then loads a series by its SeriesInstanceUID, without walking the archive.
+  It returns the same as get_dcm. Series without ImagePositionPatient are ordered by file path 
+  (descending) instead of the file system listing order.
+* Input parameter:
+    archive_path: location of the dicom archive
+    db_path: location of the SQLite index file
+    n_workers: no. of reading threads
+
+* Output:
+    Returns the no. of files that were (re)indexed
+
+Example
+========
+index_dcm_archive(r'./pacs_export', r'./pacs_index.sqlite')
+for series_uid, study_uid, n_files, folder in list_dcm_series(r'./pacs_index.sqlite'): print(series_uid, n_files, folder)
+d, pix_spacing, intensity = get_dcm_by_uid(r'./pacs_index.sqlite', series_uid)
+'''
+def open_dcm_index(db_path):
+    con = sqlite3.connect(db_path)
+    con.execute('''CREATE TABLE IF NOT EXISTS files (
+                       path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,
+                       study_uid TEXT, series_uid TEXT, position REAL, 
+                       rows INTEGER, columns INTEGER, 
+                       spacing_r REAL, spacing_c REAL, slice_thickness REAL)''')
+    con.execute('CREATE INDEX IF NOT EXISTS idx_series ON files (series_uid)')
+    return con
+
+def read_dcm_header(path):
+    '''
+    Index fields of a dicom file, or None if the file cannot be read as dicom or has no
+    SeriesInstanceUID
+    '''
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True)
+        return header_fields(ds)
+    except (pydicom.errors.InvalidDicomError, OSError, ValueError, TypeError, AttributeError):
+        return None
+
+def header_fields(ds):
+    if 'SeriesInstanceUID' not in ds: return None # cannot be fetched by UID
+    spacing = ds.get('PixelSpacing', [None, None])
+    thickness = ds.get('SliceThickness', None)
+    return (str(ds.get('StudyInstanceUID', '')), str(ds.get('SeriesInstanceUID', '')),
+            float(ds.ImagePositionPatient[-1]) if 'ImagePositionPatient' in ds else None,
+            int(ds.Rows) if 'Rows' in ds else None, int(ds.Columns) if 'Columns' in ds else None,
+            None if spacing[0] is None else float(spacing[0]), None if spacing[1] is None else float(spacing[1]),
+            None if thickness is None else float(thickness))
+
+def index_dcm_archive(archive_path, db_path, n_workers=None):
+    con = open_dcm_index(db_path)
+    known = {p: (sz, mt) for p, sz, mt in con.execute('SELECT path, size, mtime_ns FROM files')}
+    
+    # Find new or changed files. Only file system metadata is read here.
+    todo, seen = [], set()
+    for dir_name, sub_dir_list, file_list in os.walk(archive_path):
+        for file_name in file_list:
+            if ".dcm" in file_name.lower():
+                path = os.path.abspath(os.path.join(dir_name, file_name))
+                st = os.stat(path)
+                seen.add(path)
+                if known.get(path) != (st.st_size, st.st_mtime_ns): todo.append((path, st.st_size, st.st_mtime_ns))
+    
+    # Read headers in parallel. Database is written from this thread only.
+    with ThreadPoolExecutor(n_workers) as pool:
+        headers = list(pool.map(lambda t: read_dcm_header(t[0]), todo))
+    rows = [t + h for t, h in zip(todo, headers) if h is not None]
+    bad = [t[0] for t, h in zip(todo, headers) if h is None] # e.g. truncated or non-dicom files
+    if bad: print('Skipped %d unreadable files, e.g. %s' % (len(bad), bad[0]))
+    
+    with con:
+        con.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?)', rows)
+        # Remove files of this archive that do not exist anymore
+        root = os.path.join(os.path.abspath(archive_path), '')
+        gone = [(p,) for p in known if p.startswith(root) and p not in seen]
+        gone += [(p,) for p in bad if p in known] # files that became unreadable
+        con.executemany('DELETE FROM files WHERE path = ?', gone)
+    con.close()
+    
+    return len(rows)
+
+def list_dcm_series(db_path):
+    '''
+    Returns (series_uid, study_uid, no. of files, folder of the first file) of every indexed series
+    '''
+    con = open_dcm_index(db_path)
+    out = con.execute('''SELECT series_uid, study_uid, COUNT(*), MIN(path) FROM files 
+                         GROUP BY series_uid, study_uid ORDER BY study_uid, series_uid''').fetchall()
+    con.close()
+    return [(s, st, n, os.path.dirname(p)) for s, st, n, p in out]
+
+def get_dcm_by_uid(db_path, series_uid, n_workers=None):
+    con = open_dcm_index(db_path)
+    rows = con.execute('''SELECT path, position, rows, columns, spacing_r, spacing_c, slice_thickness 
+                          FROM files WHERE series_uid = ? ORDER BY path''', (series_uid,)).fetchall()
+    con.close()
+    if len(rows) == 0: raise NameError('Series not found')
+    
+    files = [r[0] for r in rows]
+    ref = rows[0]
+    pix_dim = (ref[2], ref[3], len(files))
+    pix_spacing = (ref[4], ref[5], ref[6])
+    
+    # Same slice order as get_dcm
+    if all(r[1] is not None for r in rows):
+        ps = list(np.argsort([r[1] for r in rows]))
+        ps.reverse() #slices will be sorted in descending order
+        sorted_files = [files[i] for i in ps]
+    else:
+        sorted_files = files[::-1]
+    
+    return read_dcm_files(sorted_files, pix_dim, pix_spacing, n_workers)
 
 #%% get_text
 '''
@@ -84,11 +412,12 @@ def get_dcm(dcm_path):
   So, user can change it according to their needs.
 * Input parameter:
     text_loc: tentative location of text data
+    cache: whether read_asc may use (and write) a .npy sidecar next to each file
 
 * Output:
     Returns control points in list format
 '''
-def get_text(text_loc):
+def get_text(text_loc, cache=False):
     text = []
     for dir_name, sub_dir_list, file_list in os.walk(text_loc):
         for file_name in file_list:
@@ -97,14 +426,59 @@ def get_text(text_loc):
                     text.append(os.path.join(dir_name,file_name))
     
     if len(text) == 2:
-        cp1 = np.loadtxt(text[0]) #left control points
-        cp2 = np.loadtxt(text[1]) #right control points
+        cp1 = read_asc(text[0], cache) #left control points
+        cp2 = read_asc(text[1], cache) #right control points
         return list([cp1, cp2]) #returning as a list
     elif len(text) == 1: 
-        cp1 = np.loadtxt(text[0]) #left or right control point
+        cp1 = read_asc(text[0], cache) #left or right control point
         return list(cp1) #returning as a list
     else: raise NameError('Name not found')
 
+#%% read_asc
+'''
+* 'read_asc' reads points from a .asc (text) file. It is a faster replacement of np.loadtxt.
+* The file is parsed a chunk of lines at a time. Lines starting with '#' are skipped.
+* If cache is True, a binary sidecar (file name + '.npy') is saved after parsing. Next time,
+  if the sidecar is newer than the .asc file, it is memory-mapped instead of parsing the
+  text again (copy-on-write, so the returned array can still be modified).
+* Input parameter:
+    asc_path: location of the .asc file
+    cache: whether to use the .npy sidecar
+    chunk_lines: no. of lines parsed at a time
+
+* Output:
+    Returns points as an array, same shape as np.loadtxt gives
+'''
+def read_asc(asc_path, cache=True, chunk_lines=1000000):
+    sidecar = asc_path + '.npy'
+    if cache and os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(asc_path):
+        return np.squeeze(np.load(sidecar, mmap_mode='c')) # same shape as parsing the text
+    
+    chunks = []
+    n_cols = None
+    with open(asc_path, 'r') as f:
+        while True:
+            lines = f.readlines(chunk_lines * 32) # approx. chunk_lines lines
+            if not lines: break
+            lines = [l for l in lines if l.strip() and not l.lstrip().startswith('#')]
+            if not lines: continue
+            if n_cols is None: n_cols = len(lines[0].split())
+            # Every line must have n_cols values, as np.loadtxt requires. Otherwise rows
+            # of a ragged file would be silently re-flowed by the reshape below.
+            n_fields = np.array([len(l.split()) for l in lines])
+            if np.any(n_fields != n_cols):
+                raise ValueError('%s: expected %d values per line, got %d' % (asc_path, n_cols, n_fields[n_fields != n_cols][0]))
+            chunks.append(np.fromstring(''.join(lines), dtype=float, sep=' ').reshape(-1, n_cols)) # C parser
+    
+    data = np.concatenate(chunks) if chunks else np.zeros((0,))
+    data = np.squeeze(data) # like np.loadtxt, e.g. a single row or a single column is 1D
+    
+    if cache:
+        try: np.save(sidecar, data)
+        except OSError: pass # e.g. read-only data directory, the sidecar is optional
+    
+    return data
+
 #%% get_dir
 '''
 * This code creates directory
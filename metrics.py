@@ -6,81 +6,144 @@ Created on Wed Aug 11 22:26:45 2021
 """
 import numpy as np
 import math
-from scipy.spatial import distance
+from scipy.spatial import distance, cKDTree
+from scipy import ndimage
+
+# Above this many point pairs (N*M), method='auto' switches from the dense
+# cdist matrix to the KD-tree nearest neighbour search.
+CDIST_MAX_PAIRS = 4_000_000
+
+#%%
+def nearest_dist(src_cords, dst_cords, method='auto'):
+    '''
+    This function returns, for every point in src_cords, the euclidean distance
+    to its nearest point in dst_cords.
+    Inputs:
+        - src_cords: N x d array of query coordinates
+        - dst_cords: M x d array of target coordinates
+        - method: 'cdist' builds the dense N x M distance matrix. 'kdtree' builds
+          a KD-tree over dst_cords and queries it, O((N+M) log M) time and linear
+          memory. 'auto' uses cdist for small inputs and kdtree otherwise.
+    Output:
+        - min_d: array of N nearest neighbour distances
+    '''
+    src_cords = np.asarray(src_cords, dtype=float)
+    dst_cords = np.asarray(dst_cords, dtype=float)
+    
+    if method == 'auto':
+        method = 'cdist' if len(src_cords) * len(dst_cords) <= CDIST_MAX_PAIRS else 'kdtree'
+    
+    if method == 'cdist':
+        d = distance.cdist(src_cords, dst_cords, 'euclidean')
+        min_d = np.min(d, axis=1) # find min row-wise
+    elif method == 'kdtree':
+        tree = cKDTree(dst_cords)
+        min_d, _ = tree.query(src_cords, k=1)
+    else:
+        raise ValueError('Wrong keyword for method')
+    
+    return min_d
 
 #%%
-def mcd_gt_to_pred(gt_skl, pred_skl, iso_spacing, high_value=float):
+def edt_dist(src_vol, dst_vol, spacing):
+    '''
+    This function returns, for every foreground voxel of src_vol, the euclidean
+    distance to the nearest foreground voxel of dst_vol. It computes one euclidean
+    distance transform of dst_vol and reads it at the src_vol voxels, so the cost
+    is O(volume) instead of O(N x M). Works with anisotropic voxels.
+    Inputs:
+        - src_vol: binary volume of query voxels. size: H x W x D
+        - dst_vol: binary volume of target voxels. size: H x W x D
+        - spacing: spacing between two voxels. A scalar or a per-axis tuple, e.g.
+          the pix_spacing returned by get.get_dcm
+    Output:
+        - min_d: nearest neighbour distances, in np.argwhere(src_vol) order
+    '''
+    dt = ndimage.distance_transform_edt(np.logical_not(dst_vol), sampling=spacing)
+    return dt[src_vol.astype(bool)]
+
+#%%
+def mcd_gt_to_pred(gt_skl, pred_skl, iso_spacing, high_value=float, method='auto'):
     '''
     This function calculates mean curve distance (MCD) from groundtruth to prediction.
     Inputs:
         - gt_skl: skeletonized ground truth. size: H x W x D
         - pred_skl: skeletonized prediction. size: H x W x D
-        - iso_spacing: spacing between two voxels
+        - iso_spacing: spacing between two voxels. A scalar or a per-axis tuple
         - high_value: set MCD to a high value if it fails constraints
+        - method: nearest neighbour engine, 'auto', 'kdtree' or 'cdist' (see nearest_dist),
+          or 'edt' to use a distance transform of the volume (see edt_dist)
     Output:
         - out: returns mcd value 
     '''
     EPSILON = 1e-6
     
-    gtCords = np.argwhere(gt_skl == 1)
-    n_gt = len(gtCords) # no. of ones in gt
+    gtMask = np.asarray(gt_skl) == 1
+    n_gt = np.count_nonzero(gtMask) # no. of ones in gt
     
-    predCords = np.argwhere(pred_skl == 1)
-    n_pred = len(predCords)
+    predMask = np.asarray(pred_skl) == 1
+    n_pred = np.count_nonzero(predMask)
     
     # Set constraints
     if (n_gt>0 and n_pred==0) or (n_gt==0 and n_pred>0): mcd = high_value # setting a relatively high mcd value
         
     elif n_gt==0 and n_pred == 0: mcd = 0.0
     
+    elif method == 'edt':
+        min_d = edt_dist(gtMask, predMask, iso_spacing) # nearest pred point of each gt point
+        mcd = math.fsum(min_d)/(n_gt + EPSILON)
+    
     else:
-        gtCords_matrix = iso_spacing * gtCords
-        predCords_matrix = iso_spacing * predCords
-
-        d = distance.cdist(gtCords_matrix, predCords_matrix, 'euclidean') 
+        gtCords_matrix = iso_spacing * np.argwhere(gtMask)
+        predCords_matrix = iso_spacing * np.argwhere(predMask)
 
-        min_d = np.min(d, axis=1) # find min row-wise
+        min_d = nearest_dist(gtCords_matrix, predCords_matrix, method) # nearest pred point of each gt point
         sum_d = math.fsum(min_d)
         mcd = sum_d/(n_gt + EPSILON)
     return mcd
   
 #%%
-def mcd_pred_to_gt(gt_skl, pred_skl, iso_spacing, high_value=float):
+def mcd_pred_to_gt(gt_skl, pred_skl, iso_spacing, high_value=float, method='auto'):
     '''
     This function calculates mean curve distance (MCD) from prediction to groundtruth.
     Inputs:
         - gt_skl: skeletonized ground truth. size: H x W x D
         - pred_skl: skeletonized prediction. size: H x W x D
-        - iso_spacing: spacing between two voxels
+        - iso_spacing: spacing between two voxels. A scalar or a per-axis tuple
         - high_value: set MCD to a high value if it fails constraints
+        - method: nearest neighbour engine, 'auto', 'kdtree' or 'cdist' (see nearest_dist),
+          or 'edt' to use a distance transform of the volume (see edt_dist)
     Output:
         - out: returns mcd value 
     '''    
     EPSILON = 1e-6
     
-    gtCords = np.argwhere(gt_skl == 1)
-    n_gt = len(gtCords)
+    gtMask = np.asarray(gt_skl) == 1
+    n_gt = np.count_nonzero(gtMask)
     
-    predCords = np.argwhere(pred_skl == 1)
-    n_pred = len(predCords) # no. of ones in prediction
+    predMask = np.asarray(pred_skl) == 1
+    n_pred = np.count_nonzero(predMask) # no. of ones in prediction
     
     # Set constraints
     if (n_gt>0 and n_pred==0) or (n_gt==0 and n_pred>0): mcd = high_value # setting a relatively high mcd value
         
     elif n_gt==0 and n_pred == 0: mcd = 0.0
     
+    elif method == 'edt':
+        min_d = edt_dist(predMask, gtMask, iso_spacing) # nearest gt point of each pred point
+        mcd = math.fsum(min_d)/(n_pred + EPSILON)
+    
     else:    
-        gtCord_matrix = iso_spacing * gtCords
-        predCord_matrix = iso_spacing * predCords
+        gtCord_matrix = iso_spacing * np.argwhere(gtMask)
+        predCord_matrix = iso_spacing * np.argwhere(predMask)
         
-        d = distance.cdist(predCord_matrix, gtCord_matrix, 'euclidean') 
-        min_d = np.min(d, axis=1) # find min row-wise
+        min_d = nearest_dist(predCord_matrix, gtCord_matrix, method) # nearest gt point of each pred point
         sum_d = math.fsum(min_d) 
         mcd = sum_d/(n_pred + EPSILON)
     return mcd
 
 #%%
-def mcd_GP_cord_based(gt_cords, pred_cords, high_value=float):
+def mcd_GP_cord_based(gt_cords, pred_cords, high_value=float, method='auto'):
     '''
     This function calculates mean curve distance (MCD) from groundtruth to prediction.
     Inputs:
@@ -88,6 +151,7 @@ def mcd_GP_cord_based(gt_cords, pred_cords, high_value=float):
         - pred_cords: A list that contains coordinates of the prediction contour
         - high_value: set MCD to a high value if it fails constraints. If gt mask pixels 
           exists but prediction mask not or vice versa, then set MCD score to the high_value. 
+        - method: nearest neighbour engine, 'auto', 'kdtree' or 'cdist'. See nearest_dist.
     Output:
         - out: returns mcd value 
     '''
@@ -103,15 +167,13 @@ def mcd_GP_cord_based(gt_cords, pred_cords, high_value=float):
     elif n_gt==0 and n_pred == 0: mcd = 0.0
     
     else:
-        d = distance.cdist(gt_cords, pred_cords, 'euclidean') 
-
-        min_d = np.min(d, axis=1) # find min row-wise
+        min_d = nearest_dist(gt_cords, pred_cords, method) # nearest pred point of each gt point
         sum_d = math.fsum(min_d)
         mcd = sum_d/(n_gt + EPSILON)
     return mcd
 
 #%%
-def mcd_PG_cord_based(gt_cords, pred_cords, high_value=float):
+def mcd_PG_cord_based(gt_cords, pred_cords, high_value=float, method='auto'):
     '''
     This function calculates mean curve distance (MCD) from prediction to groundtruth.
     Inputs:
@@ -119,6 +181,7 @@ def mcd_PG_cord_based(gt_cords, pred_cords, high_value=float):
         - pred_cords: A list that contains coordinates of the prediction contour
         - high_value: set MCD to a high value if it fails constraints. If gt mask pixels 
           exists but prediction mask not or vice versa, then set MCD score to the high_value. 
+        - method: nearest neighbour engine, 'auto', 'kdtree' or 'cdist'. See nearest_dist.
     Output:
         - out: returns mcd value  
     '''    
@@ -134,10 +197,63 @@ def mcd_PG_cord_based(gt_cords, pred_cords, high_value=float):
     elif n_gt==0 and n_pred == 0: mcd = 0.0
     
     else:            
-        d = distance.cdist(pred_cords, gt_cords, 'euclidean') 
-        min_d = np.min(d, axis=1) # find min row-wise
+        min_d = nearest_dist(pred_cords, gt_cords, method) # nearest gt point of each pred point
         sum_d = math.fsum(min_d) 
         mcd = sum_d/(n_pred + EPSILON)
     return mcd
 
 
+
+#%%
+def curve_distances(gt_skl, pred_skl, spacing, high_value=float, percentile=95, method='auto'):
+    '''
+    This function calculates bidirectional curve metrics in a single pass. Voxel
+    coordinates are extracted once and each nearest neighbour query is done once.
+    Inputs:
+        - gt_skl: skeletonized ground truth. size: H x W x D
+        - pred_skl: skeletonized prediction. size: H x W x D
+        - spacing: spacing between two voxels. A scalar or a per-axis tuple
+        - high_value: set all metrics to a high value if it fails constraints
+        - percentile: percentile used for the percentile Hausdorff distance, e.g. 95
+        - method: nearest neighbour engine, 'auto', 'kdtree' or 'cdist' (see nearest_dist),
+          or 'edt' to use a distance transform of the volume (see edt_dist)
+    Output:
+        - mcd_gp: MCD from groundtruth to prediction
+        - mcd_pg: MCD from prediction to groundtruth
+        - mcd_sym: symmetric MCD, the mean of mcd_gp and mcd_pg
+        - hd: maximum Hausdorff distance
+        - hd_pct: percentile Hausdorff distance (HD95 for percentile=95)
+    '''
+    EPSILON = 1e-6
+    
+    gtMask = np.asarray(gt_skl) == 1
+    n_gt = np.count_nonzero(gtMask)
+    
+    predMask = np.asarray(pred_skl) == 1
+    n_pred = np.count_nonzero(predMask)
+    
+    # Set constraints
+    if (n_gt>0 and n_pred==0) or (n_gt==0 and n_pred>0): 
+        return high_value, high_value, high_value, high_value, high_value # setting relatively high values
+        
+    elif n_gt==0 and n_pred == 0: return 0.0, 0.0, 0.0, 0.0, 0.0
+    
+    if method == 'edt':
+        min_gp = edt_dist(gtMask, predMask, spacing) # nearest pred point of each gt point
+        min_pg = edt_dist(predMask, gtMask, spacing) # nearest gt point of each pred point
+    else:
+        spacing = np.asarray(spacing, dtype=float)
+        gtCords_matrix = spacing * np.argwhere(gtMask)
+        predCords_matrix = spacing * np.argwhere(predMask)
+        
+        min_gp = nearest_dist(gtCords_matrix, predCords_matrix, method) # nearest pred point of each gt point
+        min_pg = nearest_dist(predCords_matrix, gtCords_matrix, method) # nearest gt point of each pred point
+    
+    mcd_gp = math.fsum(min_gp)/(n_gt + EPSILON)
+    mcd_pg = math.fsum(min_pg)/(n_pred + EPSILON)
+    mcd_sym = (mcd_gp + mcd_pg)/2
+    
+    hd = max(min_gp.max(), min_pg.max())
+    hd_pct = max(np.percentile(min_gp, percentile), np.percentile(min_pg, percentile))
+    
+    return mcd_gp, mcd_pg, mcd_sym, float(hd), float(hd_pct)
@@ -1,8 +1,44 @@
 import numpy as np
+import os
+import itertools
+import functools
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from skimage import measure, morphology
 from scipy.spatial import distance
+from scipy import sparse, ndimage
+from scipy.sparse import csgraph
 import cc3d
 
+#%%
+def group_labels(labels, num=None):
+    '''
+    This function groups voxel locations by label in a single pass. Foreground
+    voxels are sorted by label once, instead of searching the whole volume for
+    every label. Time is roughly linear in the no. of foreground voxels.
+    
+    INPUT parameter:
+        labels: A 3D/2D label image. 0 is background.
+        num: no. of labels. If None, labels.max() is used.
+    
+    OUTPUT:
+        coords: (n_foreground x ndim) voxel locations, grouped by label. Within
+        a label, locations are in the same order as np.where gives.
+        offsets: (num+1) array. Locations of label i are coords[offsets[i-1]:offsets[i]]
+    '''
+    flat = labels.ravel()
+    if num is None: num = int(flat.max()) if flat.size else 0
+    
+    fg = np.flatnonzero(flat) # flat indices of foreground voxels, in ascending order
+    fg_labels = flat[fg]
+    order = np.argsort(fg_labels, kind='stable') # stable, so C order is kept within a label
+    
+    coords = np.array(np.unravel_index(fg[order], labels.shape)).T
+    offsets = np.zeros(num+1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(fg_labels, minlength=num+1)[1:num+1])
+    
+    return coords, offsets
+
 #%%
 def get_ccomps(vol):
     '''
@@ -15,12 +51,12 @@ def get_ccomps(vol):
         ccomps: A dictonary that holds pixels/voxels' location
         num: no. of connected ccomps
     '''
+    vol = np.asarray(vol) # also accepts utils.SparseVolume
     labels, num = measure.label(vol, background=0, return_num=True)
     ccomps = {}
     if num > 0:
-        for i in range(1,num+1): #iterate over each cccomp
-            idx = np.where(labels == i) #find ccomp
-            ccomps[i-1] = np.array(idx).T #store row, column, and depth
+        coords, offsets = group_labels(labels, num)
+        for i in range(num): ccomps[i] = coords[offsets[i]:offsets[i+1]] #store row, column, and depth
     else: print('No connected component found')
     
     return ccomps, num
@@ -39,12 +75,12 @@ def get_and_refine_ccomps(vol):
         ccomps: A dictonary that holds voxels' location
         num: no. of connected ccomps
     '''
+    vol = np.asarray(vol) # also accepts utils.SparseVolume
     labels, num = measure.label(vol, background=0, return_num=True)
     ccomps = {}
     if num > 0:
-        for i in range(1,num+1): #iterate over each cccomp
-            idx = np.where(labels == i) #find ccomp
-            ccomps[i-1] = np.array(idx).T #store row, column, and depth
+        coords, offsets = group_labels(labels, num)
+        for i in range(num): ccomps[i] = coords[offsets[i]:offsets[i+1]] #store row, column, and depth
     else: print('No connected component found')
     
     # Check all ccomps have at least two voxels. If not then remove it. 
@@ -83,6 +119,7 @@ def del_ccomp(vol, connectivity, method, value):
     
     OUTPUT: A 3D/2D image
     '''    
+    vol = np.asarray(vol) # also accepts utils.SparseVolume
     ccomps, num = get_ccomps(vol)
     vol = vol.astype(bool) # convert to boolean
     if num != 0:
@@ -109,48 +146,79 @@ def del_ccomp3d(vol, connectivity, method, value):
         * sorted_idx: ccomp volumes will be sorted by their size in descending
         order. So, sorted_idx will be used to get the nth sorted volume.
         * connectivity: 6, 18 or 26 neighbors.
-        * method: two methods - 
+        * method: four methods - 
             'SizeOfCcomp': if 'value' is 2, then it keeps two largest ccomps
             only
             'NumOfVoxels': if 'value' is 50, then it removes ccomps smaller
             than 50
+            'SizeRange': if 'value' is (10, 50), then it removes ccomps whose
+            size is between 10 and 50 (both inclusive)
+            'BoundingBox': 'value' is a function that takes the bounding box
+            of a ccomp (a tuple of slices) and returns True to keep it. 
+            Example: lambda bbox: bbox[2].stop - bbox[2].start > 20
         * value: assign a value based on which 'method' works
     
     OUTPUT: A 3D image
     '''     
+    vol = np.asarray(vol) # also accepts utils.SparseVolume
     if connectivity not in [6, 18, 26]: raise ValueError('Wrong value for connectivity')
     
-    if method == 'SizeOfCcomp':
+    if method == 'NumOfVoxels':
+        out = cc3d.dust(vol, threshold=value, connectivity=connectivity, in_place=False)
         
-        out = np.zeros(vol.shape, vol.dtype)
+        return out
+    
+    elif method in ['SizeOfCcomp', 'SizeRange', 'BoundingBox']:
         
         labels_out, num = cc3d.connected_components(vol, connectivity=connectivity, return_N=True)
         
-        if num != 0:
-            stats = cc3d.statistics(labels_out)
-            vox_cnt = stats['voxel_counts']
-            vox_cnt_no_bg = vox_cnt[1:] # remove background count
-            vox_cnt_no_bg_sort = np.argsort(vox_cnt_no_bg)[::-1] # argsort in descending order         
-    
-            for i in range(value):
-                out[labels_out == vox_cnt_no_bg_sort[i]+1] = 1
-                # Note: 1 is added because bg count has been deleted from the voxel count list.
-                # So, index position 0, means label 1. So, label = index + 1
-                
-            return out
+        if num == 0: return np.zeros(vol.shape, vol.dtype)
         
-        else: return out
+        stats = cc3d.statistics(labels_out)
+        vox_cnt = stats['voxel_counts']
         
-    elif method == 'NumOfVoxels':
-        out = cc3d.dust(vol, threshold=value, connectivity=connectivity, in_place=False)
+        # Keep/discard decision for every label. Index 0 is the background.
+        keep = np.zeros(num+1, dtype=bool)
         
-        return out
+        if method == 'SizeOfCcomp':
+            vox_cnt_no_bg_sort = np.argsort(vox_cnt[1:], kind='stable')[::-1] # argsort in descending order
+            keep[vox_cnt_no_bg_sort[:value] + 1] = True
+            # Note: 1 is added because bg count has been deleted from the voxel count list.
+            # So, index position 0, means label 1. So, label = index + 1
+        
+        elif method == 'SizeRange':
+            keep[1:] = (vox_cnt[1:] < value[0]) | (vox_cnt[1:] > value[1])
+        
+        else: # BoundingBox
+            keep[1:] = [bool(value(bbox)) for bbox in stats['bounding_boxes'][1:]]
+        
+        return relabel_lut(labels_out, keep, vol.dtype)
+    
+    else:
+        raise NameError('Wrong keyword')
+
+#%%
+def relabel_lut(labels, keep, dtype='uint8'):
+    '''
+    This function makes a binary image from a label image and a lookup table, in
+    a single gather pass.
+    
+    INPUT arguments:
+        * labels: A 3D/2D label image
+        * keep: A boolean array indexed by label. keep[i] tells whether label i
+        is kept. keep[0] (background) should be False.
+        * dtype: data type of the output
+    
+    OUTPUT: A 3D/2D image, 1 for voxels of the kept labels and 0 otherwise
+    '''
+    return keep.astype(dtype)[labels]
 
 #%%
 def split_vol(vol):
     '''
     This function splits a 3D volume into 2 pieces
     '''
+    vol = np.asarray(vol) # also accepts utils.SparseVolume
     vol_size = vol.shape
     half_col = np.round(vol_size[1]/2).astype('int16')
     first_half = vol[:,0:half_col,:]
@@ -158,16 +226,125 @@ def split_vol(vol):
     return first_half, sec_half
 
 #%%
-def merge_vol(first_half, sec_half, vol_size):
+def merge_vol(first_half, sec_half, vol_size, dtype='uint8'):
     '''
-    This function merges two split volumes
+    This function merges two split volumes. Use dtype=None to keep the data type
+    of the split volumes.
     '''
-    out = np.zeros(vol_size, dtype='uint8')
+    out = np.zeros(vol_size, dtype=first_half.dtype if dtype is None else dtype)
     half_col = np.round(vol_size[1]/2).astype('int16')
     out[:,0:half_col,:] = first_half
     out[:,half_col:vol_size[1],:] = sec_half
     return out
 
+#%%
+def tile_slices(shape, tile_shape, halo=0):
+    '''
+    This function splits a volume of any dimension into N tiles with a halo 
+    (overlap) around each tile. 
+    
+    INPUT parameters:
+    * shape: shape of the volume
+    * tile_shape: shape of a tile without halo. Tiles at the end of an axis can 
+      be smaller.
+    * halo: no. of overlapping voxels added on each side of a tile. An int or 
+      one value per axis. It is clipped at the volume border.
+    
+    OUTPUT: a list of (core, outer, inner) slice tuples
+    * core: location of the tile in the volume, without halo
+    * outer: location of the tile in the volume, with halo
+    * inner: location of the core inside the outer tile
+    '''
+    halo = np.broadcast_to(halo, (len(shape),))
+    tiles = []
+    for core in block_slices(shape, tile_shape):
+        outer = tuple(slice(max(c.start - h, 0), min(c.stop + h, s)) for c, h, s in zip(core, halo, shape))
+        inner = tuple(slice(c.start - o.start, c.stop - o.start) for c, o in zip(core, outer))
+        tiles.append((core, outer, inner))
+    return tiles
+
+#%%
+def map_tiles(fn, vol, tile_shape, halo=0, out=None, merge='crop', n_workers=None, 
+              use_processes=False):
+    '''
+    This function applies a function tile by tile, in parallel, and merges the 
+    results. It generalizes split_vol/merge_vol to N tiles with overlap, which
+    helps to run memory hungry operations on large volumes.
+    
+    INPUT parameters:
+    * fn: function that takes a tile (with halo) and returns an array of the same
+      shape. It must be a top-level function if use_processes is True.
+    * vol: a 2D/3D volume, e.g. an array or a np.memmap
+    * tile_shape: shape of a tile without halo
+    * halo: no. of overlapping voxels on each side of a tile. See tile_slices.
+    * out: preallocated output array, e.g. a np.memmap. If None, an array of the 
+      same shape and data type as vol is created.
+    * merge: how overlapping halos are merged
+        'crop': halos are cropped, and only the core of each result is written
+        'average': overlapping results are averaged. Float outputs are accumulated
+        in out directly. Integer outputs need a float64 accumulator of the volume 
+        size, which is a temporary memory map next to out if out is a np.memmap. 
+        Averages are rounded before they are cast to an integer data type.
+    * n_workers: no. of workers
+    * use_processes: If True, a process pool is used, otherwise a thread pool
+    
+    OUTPUT:
+    * out: merged volume
+    '''
+    vol = np.asarray(vol) # also accepts utils.SparseVolume. No data is read from a np.memmap.
+    if out is None: out = np.zeros(vol.shape, dtype=vol.dtype)
+    if merge not in ['crop', 'average']: raise NameError('Wrong keyword for merge')
+    
+    tiles = tile_slices(vol.shape, tile_shape, halo)
+    
+    if merge == 'average':
+        # No. of tiles that cover a voxel is the product of the per-axis counts, 
+        # so the weights are kept as 1D arrays
+        axis_weight = [np.zeros(s, dtype='float64') for s in vol.shape]
+        for axis, w in enumerate(axis_weight):
+            for start, stop in set((o[axis].start, o[axis].stop) for _, o, _ in tiles): w[start:stop] += 1
+        
+        def weight(slc):
+            return functools.reduce(np.multiply, np.ix_(*[w[s] for w, s in zip(axis_weight, slc)]))
+        
+        is_float = np.issubdtype(out.dtype, np.floating)
+        acc_file = None
+        if is_float:
+            out[...] = 0
+            acc = out # each result is added divided by its weight
+        elif isinstance(out, np.memmap) and out.filename:
+            fd, acc_file = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(out.filename))
+            os.close(fd)
+            acc = np.lib.format.open_memmap(acc_file, mode='w+', dtype='float64', shape=vol.shape)
+        else:
+            acc = np.zeros(vol.shape, dtype='float64')
+    
+    try:
+        pool = ProcessPoolExecutor(n_workers) if use_processes else ThreadPoolExecutor(n_workers)
+        with pool:
+            # Submit a window of tiles at a time, so only a few tiles are in memory
+            window = 2 * (n_workers or os.cpu_count() or 1)
+            for start in range(0, len(tiles), window):
+                batch = tiles[start:start+window]
+                futures = [pool.submit(fn, np.asarray(vol[outer])) for _, outer, _ in batch]
+                
+                for (core, outer, inner), future in zip(batch, futures):
+                    res = future.result()
+                    if merge == 'crop':
+                        out[core] = res[inner]
+                    else:
+                        acc[outer] += res / weight(outer)
+        
+        # Integer outputs: round the averages, one tile at a time
+        if merge == 'average' and not is_float:
+            for core, _, _ in tiles: out[core] = np.rint(acc[core])
+    finally:
+        if merge == 'average' and acc_file is not None:
+            del acc
+            os.remove(acc_file)
+    
+    return out
+
 #%%
 def vol_crop(vol, r, c, d, sigma):
     '''
@@ -194,3 +371,527 @@ def vol_crop(vol, r, c, d, sigma):
                              padded_c-sigma:(padded_c+sigma)+1,padded_d-sigma:(padded_d+sigma)+1]
     return cropped_vol
 
+#%%
+def vol_crop_batch(vol, voxels, sigma):
+    '''
+    This function crops a volume around many voxels at once. The volume is padded
+    only once, and all crops are taken from a strided (sliding window) view of it
+    in a single vectorized gather.
+
+    INPUT parameters:
+    * vol: a binary 3D volume
+    * voxels: (N x 3) array or list of voxel locations (row, column, depth)
+    * sigma: It defines cropped volume size, same as in vol_crop
+
+    OUTPUT:
+    * cropped_vols: (N x (2*sigma+1) x (2*sigma+1) x (2*sigma+1)) array. 
+      cropped_vols[i] is same as vol_crop(vol, *voxels[i], sigma)
+    '''
+    voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 3)
+    size = 2*sigma + 1
+    
+    padded_vol = np.pad(vol, (sigma,), 'constant', constant_values=0)
+    windows = np.lib.stride_tricks.sliding_window_view(padded_vol, (size, size, size)) # no copy
+    
+    # Window (r, c, d) of the padded volume is centered on voxel (r, c, d) of vol
+    return windows[voxels[:,0], voxels[:,1], voxels[:,2]]
+
+
+#%%
+class ComponentIndex():
+    ''' 
+    It labels a 2D/3D binary volume once and caches its connected component 
+    statistics: label map, voxel counts, bounding boxes, centroids and voxel 
+    locations of each ccomp. Filter, remove and keep operations work on the 
+    cached index, so chaining them does not label the volume again.
+    
+    Each operation returns a new ComponentIndex that shares the cache and has 
+    an updated set of active ccomps. Use to_vol() to get the resulting volume.
+    
+    Labels start from 1. Label 0 is the background.
+    
+    Example:
+        idx = ComponentIndex(vol, connectivity=26)
+        out = idx.remove_small(50).keep_largest(2).to_vol()
+    '''
+    
+    def __init__(self, vol, connectivity=26):
+        '''
+        * vol: 3D/2D binary image
+        * connectivity: 6, 18 or 26 for 3D. 4 or 8 for 2D.
+        '''
+        if connectivity not in [4, 8, 6, 18, 26]: raise ValueError('Wrong value for connectivity')
+        
+        vol = np.asarray(vol) # also accepts utils.SparseVolume
+        self.shape = vol.shape
+        self.dtype = vol.dtype
+        self.labels, self.num = cc3d.connected_components(vol, connectivity=connectivity, return_N=True)
+        
+        stats = cc3d.statistics(self.labels)
+        self.voxel_counts = np.asarray(stats['voxel_counts'][:self.num+1], dtype=np.int64) # index 0 is bg
+        self.bounding_boxes = stats['bounding_boxes'][:self.num+1]
+        self.centroids = stats['centroids'][:self.num+1]
+        
+        self._cache = {} # lazily computed data (e.g. voxel locations), shared by derived indices
+        
+        # Active ccomps. Index 0 (background) is never active.
+        self.active = np.ones(self.num+1, dtype=bool)
+        self.active[0] = False
+    
+    def _with_active(self, active):
+        # New index that shares the cache. _cache is the same dict object, so data 
+        # computed by any derived index is reused by all of them.
+        new = object.__new__(ComponentIndex)
+        new.__dict__.update(self.__dict__)
+        new.active = active
+        new.active[0] = False
+        return new
+    
+    @property
+    def active_labels(self):
+        return np.flatnonzero(self.active)
+    
+    def coords(self, label):
+        '''
+        Voxel locations of a ccomp, in the same order as np.where gives.
+        '''
+        if 'coords' not in self._cache: self._cache['coords'] = group_labels(self.labels, self.num)
+        coords, offsets = self._cache['coords']
+        return coords[offsets[label-1]:offsets[label]]
+    
+    def ccomps(self):
+        '''
+        Voxel locations of the active ccomps as a dictionary, like get_ccomps.
+        Keys start from 0.
+        '''
+        return {i: self.coords(label) for i, label in enumerate(self.active_labels)}
+    
+    def keep(self, keep):
+        '''
+        Keeps the active ccomps for which keep[label] is True.
+        '''
+        return self._with_active(self.active & np.asarray(keep, dtype=bool))
+    
+    def remove(self, labels):
+        '''
+        Removes the given labels.
+        '''
+        active = self.active.copy()
+        active[np.asarray(labels, dtype=np.int64)] = False
+        return self._with_active(active)
+    
+    def keep_largest(self, k):
+        '''
+        Keeps the k largest active ccomps.
+        '''
+        cnt = np.where(self.active, self.voxel_counts, -1)
+        order = np.argsort(cnt, kind='stable')[::-1][:k]
+        keep = np.zeros(self.num+1, dtype=bool)
+        keep[order] = True
+        return self.keep(keep)
+    
+    def remove_small(self, min_size):
+        '''
+        Removes ccomps smaller than min_size, like del_ccomp3d 'NumOfVoxels'.
+        '''
+        return self.keep(self.voxel_counts >= min_size)
+    
+    def remove_size_range(self, min_size, max_size):
+        '''
+        Removes ccomps whose size is between min_size and max_size (both inclusive).
+        '''
+        return self.keep((self.voxel_counts < min_size) | (self.voxel_counts > max_size))
+    
+    def keep_bbox(self, fn):
+        '''
+        Keeps ccomps whose bounding box (a tuple of slices) passes fn.
+        '''
+        keep = np.zeros(self.num+1, dtype=bool)
+        for label in self.active_labels: keep[label] = bool(fn(self.bounding_boxes[label]))
+        return self.keep(keep)
+    
+    def to_vol(self, dtype=None):
+        '''
+        Binary volume of the active ccomps, made in a single gather pass.
+        '''
+        return relabel_lut(self.labels, self.active, self.dtype if dtype is None else dtype)
+
+#%%
+def block_slices(shape, block_shape):
+    '''
+    This function yields the slices of fixed-size blocks that cover a volume.
+    Blocks at the end of an axis can be smaller.
+    '''
+    ranges = [range(0, s, b) for s, b in zip(shape, block_shape)]
+    for start in itertools.product(*ranges):
+        yield tuple(slice(st, min(st+b, s)) for st, b, s in zip(start, block_shape, shape))
+
+def open_npy(vol, mode='r'):
+    '''
+    This function opens a .npy file as a memory map. Arrays are returned as they are.
+    '''
+    return np.load(vol, mmap_mode=mode) if isinstance(vol, str) else vol
+
+def label_block(vol, out, slc, connectivity, faces, block_shape):
+    '''
+    This function labels one block independently and writes the local labels to out.
+    Its first and last planes along each axis are also written to the boundary 
+    planes in faces, so that the merge step does not read them from out again.
+    faces[axis][j, 0] is the plane before the j-th block boundary along axis, and 
+    faces[axis][j, 1] the plane after it. 
+    It returns the no. of ccomps in the block.
+    '''
+    vol, out = open_npy(vol), open_npy(out, 'r+')
+    labels, num = cc3d.connected_components(np.array(vol[slc]), connectivity=connectivity, return_N=True) # writable copy
+    out[slc] = labels
+    if isinstance(out, np.memmap): out.flush()
+    
+    for axis in range(3):
+        face = open_npy(faces[axis], 'r+')
+        i = slc[axis].start // block_shape[axis] # block index along axis
+        other = tuple(s for a, s in enumerate(slc) if a != axis)
+        if i > 0: face[(i-1, 1) + other] = np.take(labels, 0, axis=axis)
+        if i < face.shape[0]: face[(i, 0) + other] = np.take(labels, -1, axis=axis)
+        if isinstance(face, np.memmap): face.flush()
+    return num
+
+def relabel_block(out, slc, offset, lut):
+    '''
+    This function converts local labels of one block to global labels.
+    global label = lut[local label + offset]
+    '''
+    out, lut = open_npy(out, 'r+'), open_npy(lut)
+    local = np.asarray(out[slc]).astype(np.int64)
+    out[slc] = np.where(local > 0, lut[local + offset], 0)
+    if isinstance(out, np.memmap): out.flush()
+
+def count_block(labels, slc, num):
+    '''
+    This function counts voxels of each label in one block.
+    '''
+    labels = open_npy(labels)
+    return np.bincount(np.asarray(labels[slc]).ravel().astype(np.int64), minlength=num+1)[:num+1]
+
+def lut_block(labels, out, slc, lut):
+    '''
+    This function writes lut[labels] of one block to out.
+    '''
+    labels, out, lut = open_npy(labels), open_npy(out, 'r+'), open_npy(lut)
+    out[slc] = lut[np.asarray(labels[slc])]
+    if isinstance(out, np.memmap): out.flush()
+
+def block_pool(vol, out, n_workers):
+    # Process pool if workers can open the volumes from disk, otherwise thread pool
+    if isinstance(vol, str) and isinstance(out, str): return ProcessPoolExecutor(n_workers)
+    return ThreadPoolExecutor(n_workers)
+
+def share_lut(lut, vol, out):
+    '''
+    This function saves a lookup table once, next to out, if the blocks are processed
+    in a process pool, so that workers memory-map it instead of receiving a pickled 
+    copy per block. It returns the path, or the lut itself for a thread pool.
+    '''
+    if not (isinstance(vol, str) and isinstance(out, str)): return lut
+    lut_path = os.path.splitext(out)[0] + '_lut.npy'
+    np.save(lut_path, lut)
+    return lut_path
+
+def merge_block_faces(vol, out, blocks, faces, shape, block_shape, connectivity, n_workers):
+    '''
+    Step 1 and 2 of label_ccomps_blocks. Blocks are labeled independently, then the
+    touching provisional label pairs are found from the boundary planes in faces.
+    It returns the pairs, the no. of ccomps of each block, the label offsets of 
+    the blocks and the total no. of provisional labels.
+    '''
+    # Step 1: label blocks independently
+    with block_pool(vol, out, n_workers) as pool:
+        nums = list(pool.map(label_block, itertools.repeat(vol), itertools.repeat(out), 
+                             blocks, itertools.repeat(connectivity), itertools.repeat(faces),
+                             itertools.repeat(block_shape)))
+    
+    # Provisional global label = local label + offset of the block
+    n_blocks = [len(range(0, s, b)) for s, b in zip(shape, block_shape)]
+    offsets = np.concatenate([[0], np.cumsum(nums)[:-1]]).astype(np.int64).reshape(n_blocks)
+    total = int(np.sum(nums))
+    
+    # Step 2: find touching label pairs across block boundaries
+    if connectivity == 6: shifts = [(0, 0)]
+    elif connectivity == 18: shifts = [(d1, d2) for d1 in (-1, 0, 1) for d2 in (-1, 0, 1) if abs(d1) + abs(d2) <= 1]
+    else: shifts = [(d1, d2) for d1 in (-1, 0, 1) for d2 in (-1, 0, 1)]
+    
+    def plane(axis, k, side):
+        # Provisional labels of the plane vol[..., k, ...] along axis. side 0 is the
+        # plane before the boundary at k, side 1 the plane after it.
+        j = k // block_shape[axis] - 1 # boundary index
+        local = np.asarray(open_npy(faces[axis])[j, side]).astype(np.int64)
+        k = k - 1 + side
+        block_idx = [np.arange(s) // b for s, b in zip(shape, block_shape)]
+        block_idx[axis] = np.array([k // block_shape[axis]])
+        off = offsets[np.ix_(*block_idx)].squeeze(axis=axis)
+        return np.where(local > 0, local + off, 0)
+    
+    edges = []
+    for axis in range(3):
+        for k in range(block_shape[axis], shape[axis], block_shape[axis]):
+            a, b = plane(axis, k, 0), plane(axis, k, 1)
+            n1, n2 = a.shape
+            for d1, d2 in shifts:
+                pa = a[max(0, -d1):n1-max(0, d1), max(0, -d2):n2-max(0, d2)]
+                pb = b[max(0, d1):n1-max(0, -d1), max(0, d2):n2-max(0, -d2)]
+                touch = (pa > 0) & (pb > 0)
+                if touch.any(): edges.append(np.unique(np.stack([pa[touch], pb[touch]], axis=1), axis=0))
+    
+    return edges, nums, offsets, total
+
+#%%
+def label_ccomps_blocks(vol, out, block_shape=(128, 128, 128), connectivity=26, 
+                        dtype='uint32', n_workers=None):
+    '''
+    This function labels ccomps of a 3D volume that is larger than RAM. 
+    
+    Fixed-size blocks are labeled independently, in parallel. Then ccomps that
+    touch across block faces (and edges and corners) are merged: for every block
+    boundary, the two planes on either side are compared, and the touching label
+    pairs are joined with a graph connected components pass (union-find). 
+    Finally, the global label map is written back to disk block by block. 
+    Block faces are saved as boundary planes while labeling (next to out if out is a 
+    path), so the merge does not read the label map again. Only one block per worker 
+    and two planes are in memory at a time.
+    
+    INPUT arguments:
+        * vol: 3D binary volume. Path of a .npy file (opened as a memory map), 
+        a np.memmap or an array. 
+        * out: Path of the output .npy label map, or a preallocated array 
+        (e.g. a np.memmap) of the same shape as vol.
+        * block_shape: Block size
+        * connectivity: 6, 18 or 26 neighbors
+        * dtype: data type of the label map, if out is a path
+        * n_workers: No. of workers. Paths use a process pool, arrays a thread pool.
+    
+    OUTPUT:
+        * labels: global label map (a np.memmap if out is a path)
+        * num: no. of ccomps
+    '''
+    if connectivity not in [6, 18, 26]: raise ValueError('Wrong value for connectivity')
+    
+    if not isinstance(vol, str): vol = np.asarray(vol) # also accepts utils.SparseVolume
+    shape = open_npy(vol).shape
+    if isinstance(out, str): 
+        np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape).flush()
+    
+    blocks = list(block_slices(shape, block_shape))
+    
+    # Boundary planes on both sides of every block boundary, filled by label_block.
+    # They are stored next to out if out is a path, so they are read contiguously.
+    face_dtype = np.dtype(dtype) if isinstance(out, str) else out.dtype
+    faces = []
+    for axis in range(3):
+        face_shape = (len(range(block_shape[axis], shape[axis], block_shape[axis])), 2) + \
+                     tuple(s for a, s in enumerate(shape) if a != axis)
+        if isinstance(out, str):
+            faces.append(os.path.splitext(out)[0] + '_faces%d.npy' % axis)
+            np.lib.format.open_memmap(faces[-1], mode='w+', dtype=face_dtype, shape=face_shape).flush()
+        else:
+            faces.append(np.zeros(face_shape, dtype=face_dtype))
+    
+    try:
+        edges, nums, offsets, total = merge_block_faces(vol, out, blocks, faces, shape, block_shape, 
+                                                        connectivity, n_workers)
+    finally:
+        for face in faces:
+            if isinstance(face, str): os.remove(face)
+    
+    # Step 3: merge touching labels and make compact global labels
+    edges = np.concatenate(edges) if edges else np.zeros((0, 2), dtype=np.int64)
+    graph = sparse.coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(total+1, total+1))
+    _, comp = csgraph.connected_components(graph, directed=False)
+    lut = np.zeros(total+1, dtype=np.int64)
+    _, lut[1:] = np.unique(comp[1:], return_inverse=True)
+    lut[1:] += 1
+    num = int(lut.max()) if total > 0 else 0
+    
+    # Step 4: write global labels
+    lut = share_lut(lut, vol, out)
+    try:
+        with block_pool(vol, out, n_workers) as pool:
+            flat_offsets = offsets.ravel()
+            list(pool.map(relabel_block, itertools.repeat(out), blocks, flat_offsets, itertools.repeat(lut)))
+    finally:
+        if isinstance(lut, str): os.remove(lut)
+    
+    return open_npy(out, 'r+'), num
+
+#%%
+def del_ccomp_blocks(labels, num, out, method, value, block_shape=(128, 128, 128), n_workers=None):
+    '''
+    This function deletes ccomps of a label map that is larger than RAM, e.g. the
+    one from label_ccomps_blocks. Voxel counts are accumulated block by block, and 
+    the output is written block by block with a lookup table.
+    
+    INPUT arguments:
+        * labels: Path of a .npy label map, or an array
+        * num: no. of ccomps
+        * out: Path of the output .npy file, or a preallocated array
+        * method: Same as in del_ccomp3d. 'SizeOfCcomp' keeps the 'value' largest 
+        ccomps. 'NumOfVoxels' removes ccomps smaller than 'value'. 
+        * value: assign a value based on which 'method' works
+        * block_shape: Block size
+        * n_workers: No. of workers
+    
+    OUTPUT: A binary (uint8) volume (a np.memmap if out is a path)
+    '''
+    if not isinstance(labels, str): labels = np.asarray(labels)
+    shape = open_npy(labels).shape
+    if isinstance(out, str): 
+        np.lib.format.open_memmap(out, mode='w+', dtype='uint8', shape=shape).flush()
+    
+    blocks = list(block_slices(shape, block_shape))
+    
+    with block_pool(labels, out, n_workers) as pool:
+        # Counts are added up as they arrive, a window of blocks at a time, so only a
+        # few count arrays are in memory
+        vox_cnt = np.zeros(num+1, dtype=np.int64)
+        window = 2 * (n_workers or os.cpu_count() or 1)
+        for start in range(0, len(blocks), window):
+            for cnt in pool.map(count_block, itertools.repeat(labels), blocks[start:start+window], 
+                                itertools.repeat(num)):
+                vox_cnt += cnt
+        
+        keep = np.zeros(num+1, dtype=bool)
+        if method == 'SizeOfCcomp':
+            vox_cnt_no_bg_sort = np.argsort(vox_cnt[1:], kind='stable')[::-1]
+            keep[vox_cnt_no_bg_sort[:value] + 1] = True
+        elif method == 'NumOfVoxels':
+            keep[1:] = vox_cnt[1:] >= value
+        else:
+            raise NameError('Wrong keyword')
+        
+        keep = share_lut(keep.astype('uint8'), labels, out)
+        try:
+            list(pool.map(lut_block, itertools.repeat(labels), itertools.repeat(out), blocks, 
+                          itertools.repeat(keep)))
+        finally:
+            if isinstance(keep, str): os.remove(keep)
+    
+    return open_npy(out, 'r+')
+
+#%%
+def neighbour_count(skl):
+    '''
+    This function counts the 26 neighbours (8 in 2D) of every skeleton voxel 
+    with a single convolution, instead of cropping around each voxel with vol_crop.
+    
+    INPUT parameter:
+        skl: A 3D/2D binary skeleton
+    
+    OUTPUT:
+        count: Volume of the same size. count[r,c,d] is the no. of skeleton 
+        neighbours of voxel (r,c,d). It is 0 for background voxels.
+    '''
+    skl = (np.asarray(skl) > 0).astype(np.uint8)
+    kernel = np.ones((3,) * skl.ndim, dtype=np.uint8)
+    kernel[(1,) * skl.ndim] = 0 # do not count the voxel itself
+    count = ndimage.convolve(skl, kernel, mode='constant', cval=0)
+    return count * skl
+
+#%%
+def skeleton_graph(voxels, shape):
+    '''
+    This function makes the 26-neighbour (8 in 2D) adjacency graph of a set of
+    voxels. Edges are weighted by the euclidean distance between voxels.
+    
+    INPUT parameter:
+        voxels: (N x ndim) voxel locations
+        shape: shape of the volume
+    
+    OUTPUT: A sparse N x N matrix. Row/column i is voxel voxels[i].
+    '''
+    voxels = np.asarray(voxels, dtype=np.int64)
+    ndim = voxels.shape[1]
+    lin = np.ravel_multi_index(voxels.T, shape)
+    order = np.argsort(lin)
+    lin_sorted = lin[order]
+    
+    rows, cols, weights = [], [], []
+    for off in itertools.product((-1, 0, 1), repeat=ndim):
+        if off <= (0,) * ndim: continue # each pair once, and skip the voxel itself
+        nb = voxels + off
+        inside = np.all((nb >= 0) & (nb < shape), axis=1)
+        nb_lin = np.ravel_multi_index(nb[inside].T, shape)
+        pos = np.searchsorted(lin_sorted, nb_lin)
+        pos[pos == len(lin_sorted)] = 0
+        found = lin_sorted[pos] == nb_lin
+        rows.append(np.flatnonzero(inside)[found])
+        cols.append(order[pos[found]])
+        weights.append(np.full(found.sum(), np.sqrt(np.sum(np.abs(off)))))
+    
+    rows, cols, weights = np.concatenate(rows), np.concatenate(cols), np.concatenate(weights)
+    n = len(voxels)
+    return sparse.coo_matrix((weights, (rows, cols)), shape=(n, n)).tocsr()
+
+#%%
+def skeleton_topology(skl):
+    '''
+    This function finds endpoints and branch points of a skeleton and splits it
+    into branch segments, without a python loop over voxels.
+    
+    A voxel with 1 neighbour is an endpoint, and a voxel with 3 or more neighbours 
+    is a branch point. Removing branch points splits the skeleton into segments. 
+    Voxels of each segment are ordered along the segment, starting from one of
+    its ends, by the geodesic distance from that end. A closed loop is cut open 
+    at its first voxel and ordered around the loop. So, a segment can be passed
+    to utils.sampling directly.
+    
+    INPUT parameter:
+        skl: A 3D/2D binary skeleton
+    
+    OUTPUT:
+        endpoints: (n x ndim) endpoint locations
+        branch_points: (m x ndim) branch point locations
+        segments: a list of ordered (k x ndim) voxel locations, one per segment.
+        Branch points are not included in segments.
+    '''
+    skl = np.asarray(skl) > 0
+    count = neighbour_count(skl)
+    
+    endpoints = np.argwhere(skl & (count == 1))
+    branch = skl & (count >= 3)
+    branch_points = np.argwhere(branch)
+    
+    # Segments: skeleton without branch points
+    seg_vol = skl & ~branch
+    voxels = np.argwhere(seg_vol)
+    if len(voxels) == 0: return endpoints, branch_points, []
+    
+    graph = skeleton_graph(voxels, skl.shape)
+    num, seg_label = csgraph.connected_components(graph, directed=False)
+    
+    # Start of each segment: a voxel with at most 1 neighbour in the segment.
+    # Closed loops have no such voxel, so their first voxel is used.
+    graph = (graph + graph.T).tocsr() # both directions
+    seg_degree = np.diff(graph.indptr)
+    is_end = seg_degree <= 1
+    _, start = np.unique(seg_label, return_index=True)
+    end_labels, first_end = np.unique(seg_label[is_end], return_index=True)
+    start[end_labels] = np.flatnonzero(is_end)[first_end]
+    
+    # Cut each loop open at its start voxel (remove the edge to one neighbour), 
+    # so that the loop is walked in one direction
+    is_loop = np.ones(num, dtype=bool)
+    is_loop[end_labels] = False
+    cut_a = start[is_loop]
+    if len(cut_a):
+        cut_b = graph.indices[graph.indptr[cut_a]] # first neighbour of each loop start
+        n = len(voxels)
+        g = graph.tocoo()
+        key = g.row.astype(np.int64) * n + g.col
+        cut = np.isin(key, np.concatenate([cut_a.astype(np.int64) * n + cut_b, cut_b.astype(np.int64) * n + cut_a]))
+        graph = sparse.coo_matrix((g.data[~cut], (g.row[~cut], g.col[~cut])), shape=(n, n)).tocsr()
+    
+    # Order voxels by geodesic distance from the start of their segment
+    dist = csgraph.dijkstra(graph, directed=False, indices=start, min_only=True)
+    order = np.lexsort((dist, seg_label))
+    bounds = np.cumsum(np.bincount(seg_label, minlength=num))[:-1]
+    segments = np.split(voxels[order], bounds)
+    
+    return endpoints, branch_points, segments
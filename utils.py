@@ -1,4 +1,5 @@
 import numpy as np
+import math
 
 #%%
 def isNestedList(input):
@@ -36,14 +37,52 @@ def vec2angle(v1, v2, unit='radian'):
     angle = vec2angle(v1, v2, unit='degree')
 
     '''
-    unit_v1 = v1 / np.linalg.norm(v1) # unit vector of v1
-    unit_v2 = v2 / np.linalg.norm(v2) # unit vector of v2
-    dp = np.dot(unit_v1, unit_v2) # dot product
-    angle = np.arccos(dp) # calculate inverse cos to get the angle
+    if unit not in ['degree', 'radian']: 
+        print('Wrong keyword for unit')
+        return
     
-    if unit == 'degree': return np.rad2deg(angle)
-    elif unit == 'radian': return angle
-    else: print('Wrong keyword for unit')
+    return vec2angle_batch(np.atleast_2d(v1), np.atleast_2d(v2), unit=unit)[0]
+
+#%%
+def vec2angle_batch(v1, v2, unit='radian', out=None):
+    '''
+    It calculates angles between N pairs of vectors in one call. The cosine is 
+    clipped to [-1, 1], so rounding errors do not give NaN. Zero vectors give NaN.
+    
+    Input
+    --------
+    v1: (N,d) array of vectors
+    v2: (N,d) array of vectors
+    unit: Either radian or degree
+    out: optional (N,) float array to write the angles to, to avoid reallocating
+         it in loops
+    
+    Output
+    --------
+    angle: (N,) array of angles between v1[i] and v2[i]
+    
+    Example
+    --------
+    v1 = np.random.rand(1000000, 3)
+    v2 = np.random.rand(1000000, 3)
+    
+    angle = vec2angle_batch(v1, v2, unit='degree')
+    '''
+    if unit not in ['degree', 'radian']: raise ValueError('Wrong keyword for unit')
+    
+    v1 = np.asarray(v1, dtype=float)
+    v2 = np.asarray(v2, dtype=float)
+    
+    dp = np.einsum('ij,ij->i', v1, v2) # dot products
+    norm = np.sqrt(np.einsum('ij,ij->i', v1, v1) * np.einsum('ij,ij->i', v2, v2))
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angle = np.divide(dp, norm, out=out)
+    np.clip(angle, -1, 1, out=angle)
+    np.arccos(angle, out=angle) # calculate inverse cos to get the angle
+    
+    if unit == 'degree': np.rad2deg(angle, out=angle)
+    return angle
     
 #%%
 def points2vec(p1, p2):
@@ -67,12 +106,25 @@ def points2vec(p1, p2):
     
     '''
     assert len(p1)==len(p2), 'Lenght of two points are not equal'
-    
-    # If points are in list or tuple, convert to numpy array
-    if isinstance(p1, (list, tuple)): p1 = np.array(p1)
-    if isinstance(p2, (list, tuple)): p2 = np.array(p2)
         
-    return list(p2 - p1)
+    return list(points2vec_batch(np.atleast_2d(p1), np.atleast_2d(p2))[0])
+
+#%%
+def points2vec_batch(p1, p2, out=None):
+    '''
+    It calculates the vectors from N pairs of points in one call.
+    
+    Input
+    -------
+    p1: (N,d) array of start points
+    p2: (N,d) array of end points
+    out: optional (N,d) array to write the vectors to, to avoid reallocating it in loops
+    
+    Output
+    -------
+    (N,d) array of vectors p2[i] - p1[i]
+    '''
+    return np.subtract(p2, p1, out=out)
         
 #%%
 def sampling(voxels, p1_idx=0, step=5, step_range=(1,5), angle_range=(5,30), rate=0.2, verbose=False):
@@ -89,7 +141,7 @@ def sampling(voxels, p1_idx=0, step=5, step_range=(1,5), angle_range=(5,30), rat
         
     Input
     -----------
-    voxels: list of points. Example: [[x1,y1,z1], [x2,y2,z2], ...]
+    voxels: list (or array) of points. Example: [[x1,y1,z1], [x2,y2,z2], ...]
     p1_idx: index of the first sampleing point
     step: step size
     step_range: min and max allowed value for step size
@@ -114,7 +166,33 @@ def sampling(voxels, p1_idx=0, step=5, step_range=(1,5), angle_range=(5,30), rat
     sample_points = sampling(voxels, p1_idx=0, step=5, step_range=(1,5), 
                          angle_range=(5,30), rate=0.2, verbose=False)
     '''
-    sample_points = []
+    idx = sampling_idx(voxels, p1_idx=p1_idx, step=step, step_range=step_range, 
+                       angle_range=angle_range, rate=rate, verbose=verbose)
+    
+    sample_points = [voxels[i] for i in idx]
+        
+    return sample_points             
+
+#%%
+def sampling_idx(voxels, p1_idx=0, step=5, step_range=(1,5), angle_range=(5,30), rate=0.2, verbose=False):
+    '''
+    Array-native version of sampling. It uses the same step adaptation rules, but 
+    it works on an (N,3) array and returns indices of the sampled points. 
+    Coordinates are converted once, and angles are calculated with scalar math 
+    (clipped to avoid NaN), without building lists or small arrays at each step.
+    
+    Input
+    -----------
+    voxels: (N,3) array (or list) of points
+    p1_idx, step, step_range, angle_range, rate, verbose: same as in sampling
+    
+    Output
+    -----------
+    idx: (M,) int array. voxels[idx] are the sampled points.
+    '''
+    pts = np.asarray(voxels, dtype=float).tolist() # python floats are fastest for scalar math
+    n = len(pts)
+    idx = []
     
     while(True):
     
@@ -131,57 +209,123 @@ def sampling(voxels, p1_idx=0, step=5, step_range=(1,5), angle_range=(5,30), rat
         p2_idx = int(p1_idx + step)
         p3_idx = int(p2_idx + step) 
         
-        # Stopping criterion: If p1_idx exceeds range, then append last voxel, and then break 
-        if p1_idx >= len(voxels)-1: 
-            sample_points.append(voxels[-1])
+        # Stopping criteria
+        if p1_idx >= n-1: 
+            idx.append(n-1)
             if verbose: print('Terminating as p1_idx exceeds range')
             break
         
-        # Stopping criterion: If p2_idx exceeds range, then append p1 and last voxel, and then break 
-        if p2_idx >= len(voxels)-1: 
-            sample_points.append(voxels[p1_idx])
-            sample_points.append(voxels[-1])
+        if p2_idx >= n-1: 
+            idx.extend([p1_idx, n-1])
             if verbose: print('Terminating as p2_idx exceeds range')
             break
         
-        # Stopping criterion: If p3_idx exceeds range, then append p1, p2 and last voxel, and then break 
-        if p3_idx >= len(voxels)-1: 
-            sample_points.append(voxels[p1_idx])
-            sample_points.append(voxels[p2_idx])
-            sample_points.append(voxels[-1])
+        if p3_idx >= n-1: 
+            idx.extend([p1_idx, p2_idx, n-1])
             if verbose: print('Terminating as p3_idx exceeds range')
             break
         
-        # Calcuate vectors p1p2 and p2p3
-        v12 = points2vec(voxels[p1_idx], voxels[p2_idx])
-        v23 = points2vec(voxels[p2_idx], voxels[p3_idx])
-        
-        # Calculate angle between vectors
-        angle = vec2angle(v12, v23, unit='degree')
+        # Angle between vectors p1p2 and p2p3
+        p1, p2, p3 = pts[p1_idx], pts[p2_idx], pts[p3_idx]
+        v12 = [b - a for a, b in zip(p1, p2)]
+        v23 = [b - a for a, b in zip(p2, p3)]
+        norm = math.sqrt(sum(a*a for a in v12)) * math.sqrt(sum(b*b for b in v23))
+        if norm > 0: 
+            dp = sum(a*b for a, b in zip(v12, v23)) / norm
+            angle = math.degrees(math.acos(min(1.0, max(-1.0, dp))))
+        else: 
+            angle = float('nan') # repeated point. Step size does not change.
         if verbose: print('Angle: ', angle)
         
         # Redefine step size based on angle
         if angle >= angle_range[0] and angle <= angle_range[1]: 
             if verbose: print('Step size -- no change')
-            pass # no need to change step size
         elif angle < angle_range[0]: 
             step = step * (1 + rate) # increase step size
             if verbose: print('Step size -- increased')
         elif angle > angle_range[1]: 
             step = step * (1 - rate) # reduce step size
             if verbose: print('Step size -- decreased')
-    #        continue # do this sampling again, no sample will be appended
-                
-        # Store sample points p1 and p2. Don't need to store p3, it will stored in
-        # the next iteration as it will  become p1 then.
-        sample_points.append(voxels[p1_idx])
-        sample_points.append(voxels[p2_idx])
-    #    sample_points.append(voxels[p3_idx])
-        
-        # Update index of the first point
+        
+        # Store sample points p1 and p2. p3 becomes p1 of the next iteration.
+        idx.extend([p1_idx, p2_idx])
         p1_idx = p3_idx
         
-    return sample_points             
+    return np.array(idx, dtype=np.int64)
+
+#%%
+def sampling_batch(curves, p1_idx=0, step=5, step_range=(1,5), angle_range=(5,30), rate=0.2):
+    '''
+    It samples many curves at once. All curves are stepped together, and each 
+    step is vectorized over the curves, so the python loop runs as many times as
+    the longest sampling, not once per point of every curve. 
+    Results are same as sampling_idx for each curve.
+    
+    Input
+    -----------
+    curves: list of (N_i, d) arrays of points
+    p1_idx, step, step_range, angle_range, rate: same as in sampling
+    
+    Output
+    -----------
+    idx: list of int arrays. curves[i][idx[i]] are the sampled points of curve i.
+    '''
+    curves = [np.asarray(c, dtype=float) for c in curves]
+    n_curves = len(curves)
+    if n_curves == 0: return []
+    
+    n = np.array([len(c) for c in curves], dtype=np.int64)
+    offset = np.concatenate([[0], np.cumsum(n)[:-1]])
+    pts = np.concatenate(curves)
+    
+    p1 = np.full(n_curves, p1_idx, dtype=np.int64)
+    stp = np.full(n_curves, step, dtype=float)
+    active = np.ones(n_curves, dtype=bool)
+    
+    out_curve, out_idx = [], [] # appended (curve, index) pairs, in order
+    def emit(mask, values):
+        out_curve.append(np.flatnonzero(mask))
+        out_idx.append(values[mask])
+    
+    while active.any():
+        # Ensure limits of step size
+        stp = np.clip(stp, step_range[0], step_range[1])
+        
+        p2 = (p1 + stp).astype(np.int64)
+        p3 = (p2 + stp).astype(np.int64)
+        last = n - 1
+        
+        # Stopping criteria
+        stop1 = active & (p1 >= last)
+        stop2 = active & ~stop1 & (p2 >= last)
+        stop3 = active & ~stop1 & ~stop2 & (p3 >= last)
+        go = active & ~(stop1 | stop2 | stop3)
+        
+        emit(stop1, last)
+        emit(stop2, p1); emit(stop2, last)
+        emit(stop3, p1); emit(stop3, p2); emit(stop3, last)
+        
+        # Angle between vectors p1p2 and p2p3 of the running curves
+        g = np.flatnonzero(go)
+        a, b, c = pts[offset[g] + p1[g]], pts[offset[g] + p2[g]], pts[offset[g] + p3[g]]
+        angle = vec2angle_batch(points2vec_batch(a, b), points2vec_batch(b, c), unit='degree')
+        # angle is NaN for a repeated point. Then step size does not change.
+        
+        grow = angle < angle_range[0]
+        shrink = angle > angle_range[1]
+        stp[g[grow]] *= (1 + rate)
+        stp[g[shrink]] *= (1 - rate)
+        
+        emit(go, p1); emit(go, p2)
+        p1 = np.where(go, p3, p1)
+        active = go
+    
+    # Group the emitted indices by curve, keeping their order
+    out_curve, out_idx = np.concatenate(out_curve), np.concatenate(out_idx)
+    order = np.argsort(out_curve, kind='stable')
+    bounds = np.cumsum(np.bincount(out_curve, minlength=n_curves))[:-1]
+    
+    return np.split(out_idx[order], bounds)
         
 #%%
 def create_vol(shape, dtype, voxels, data):
@@ -209,11 +353,145 @@ def create_vol(shape, dtype, voxels, data):
     return vol
 
 #%%
-def xyz2asc(data, name):
+def create_sparse_vol(shape, dtype, voxels, data):
     '''
-    It writes x, y, and z values to a .asc file.
+    Sparse version of create_vol. It stores only the given voxels and their 
+    values, instead of allocating the whole volume.
+    
+    Input
+    -------
+    shape, dtype, voxels, data: same as in create_vol
+    
+    Output
+    --------
+    vol: a SparseVolume
     '''
-    f = open(name, 'w')
-    for d in data: print("%f %f %f" % (d[0], d[1], d[2]), file=f)
-    f.close()
+    return SparseVolume.from_voxels(shape, voxels, data, dtype)
+
+#%%
+class SparseVolume():
+    '''
+    A compact volume that stores only its non-zero voxels, as sorted linear 
+    indices and values. A few thousand canal voxels in a 600x600x600 scan take
+    a few kilobytes instead of hundreds of megabytes.
+    
+    np.asarray(vol) (or vol.to_dense()) gives the dense volume, so it can be 
+    passed to the morph and metrics functions.
+    
+    Example
+    --------
+    vol = SparseVolume.from_voxels((600, 600, 600), voxels, 1)
+    both = vol.intersect(other)
+    dense = both.to_dense()
+    '''
+    
+    def __init__(self, shape, index=None, values=None, dtype='uint8'):
+        '''
+        shape: shape of the volume
+        index: sorted, unique linear (C order) indices of the non-zero voxels
+        values: values of the voxels
+        dtype: data type of the values
+        '''
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.index = np.zeros(0, dtype=np.int64) if index is None else np.asarray(index, dtype=np.int64)
+        self.values = np.zeros(len(self.index), self.dtype) if values is None else np.asarray(values, self.dtype)
+    
+    @classmethod
+    def from_dense(cls, vol):
+        vol = np.asarray(vol)
+        index = np.flatnonzero(vol)
+        return cls(vol.shape, index, vol.ravel()[index], vol.dtype)
+    
+    @classmethod
+    def from_voxels(cls, shape, voxels, data=1, dtype='uint8'):
+        voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, len(shape))
+        index = np.ravel_multi_index(voxels.T, shape)
+        values = np.broadcast_to(np.asarray(data, dtype), index.shape)
+        
+        # Like dense assignment, the last value of a repeated voxel is kept
+        index, last = np.unique(index[::-1], return_index=True)
+        values = values[::-1][last]
+        
+        keep = values != 0
+        return cls(shape, index[keep], values[keep], dtype)
+    
+    @property
+    def nnz(self):
+        return len(self.index)
+    
+    @property
+    def nbytes(self):
+        return self.index.nbytes + self.values.nbytes
+    
+    def voxels(self):
+        '''
+        (nnz x ndim) voxel locations, in the same order as np.argwhere gives
+        '''
+        return np.array(np.unravel_index(self.index, self.shape)).T.reshape(-1, len(self.shape))
+    
+    def lookup(self, label):
+        '''
+        Voxel locations whose value is label
+        '''
+        return self.voxels()[self.values == label]
+    
+    def labels(self):
+        '''
+        Unique non-zero values
+        '''
+        return np.unique(self.values)
+    
+    def union(self, other):
+        '''
+        Voxels of both volumes. Where both have a voxel, the value of other is kept.
+        '''
+        assert self.shape == other.shape, 'Shapes are not equal'
+        index = np.concatenate([self.index, other.index])
+        values = np.concatenate([self.values, other.values.astype(self.dtype)])
+        index, last = np.unique(index[::-1], return_index=True)
+        return SparseVolume(self.shape, index, values[::-1][last], self.dtype)
+    
+    def intersect(self, other):
+        '''
+        Voxels that are in both volumes, with the values of this volume
+        '''
+        assert self.shape == other.shape, 'Shapes are not equal'
+        mask = np.isin(self.index, other.index, assume_unique=True)
+        return SparseVolume(self.shape, self.index[mask], self.values[mask], self.dtype)
+    
+    def to_dense(self, dtype=None):
+        vol = np.zeros(self.shape, self.dtype if dtype is None else dtype)
+        vol.ravel()[self.index] = self.values
+        return vol
+    
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(dtype)
+    
+    def __repr__(self):
+        return 'SparseVolume(shape=%s, nnz=%d, dtype=%s)' % (self.shape, self.nnz, self.dtype)
+
+#%%
+def xyz2asc(data, name, chunk_size=100000, sidecar=False):
+    '''
+    It writes x, y, and z values to a .asc file. Points are formatted a chunk
+    at a time with a single string operation, instead of one print per point.
+    
+    Input
+    -------
+    data: (N,3) array or list of points. Only the first 3 columns are written.
+    name: name of the .asc file
+    chunk_size: no. of points formatted at a time
+    sidecar: (bool) If True, a binary copy is also saved as name + '.npy'. 
+             get.read_asc loads it instead of parsing the text file.
+    '''
+    data = np.asarray(data, dtype=float)
+    data = data.reshape(-1, data.shape[-1])[:, :3] if data.size else np.zeros((0, 3))
+    
+    with open(name, 'w') as f:
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start+chunk_size]
+            f.write(("%f %f %f\n" * len(chunk)) % tuple(chunk.ravel()))
+    
+    if sidecar: np.save(name + '.npy', np.squeeze(data) if data.size else np.zeros((0,))) # same shape as get.read_asc gives
 